@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+'''
+Compare the lxml activity-stream extractor in publishers.jira_pub with the
+feedparser approach it replaced.
+
+Run from the top of the repo (publishers.jira_pub reads ~/.m6rc):
+
+    python -m benchmarks.bench_atom
+'''
+
+import re
+import timeit
+
+import feedparser
+
+from publishers.jira_pub import get_logged_issues, parse_html
+
+ATOM_FILE = 'test_data/atom.xml'
+NUMBER = 50
+
+
+def feedparser_logged_issues(atom_xml):
+    '''
+    The old implementation: feedparser over the whole feed, then an HTML
+    parse for every matching title
+    '''
+    parsed = feedparser.parse(atom_xml)
+    entries = [x['title'] for
+               x in parsed['entries'] if 'logged' in x['title']]
+    issue_keys = list()
+    for entry in entries:
+        text = parse_html(entry)
+        issue_keys.append(re.search(r'^(\S+)', text[2]).group(1))
+    return sorted(set(issue_keys))
+
+
+def main():
+    atom_xml = open(ATOM_FILE, 'r').read()
+    assert feedparser_logged_issues(atom_xml) == get_logged_issues(atom_xml)
+
+    results = list()
+    for func in (feedparser_logged_issues, get_logged_issues):
+        seconds = min(timeit.repeat(lambda: func(atom_xml), repeat=3,
+                                    number=NUMBER)) / NUMBER
+        results.append(seconds)
+        print '{:<28} {:8.2f} ms'.format(func.__name__, seconds * 1000)
+    print 'speedup: {:.1f}x'.format(results[0] / results[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+Compare reading the OmniFocus documents in test_data the way
+publishers.omnifocus does by default (read_stream, with the tag-dispatch
+task extractor) with parsing them whole and using the regex and xpath
+extractor it replaced.
+
+Run from the top of the repo (publishers.omnifocus reads ~/.m6rc):
+
+    python -m benchmarks.bench_omnifocus
+'''
+
+import glob
+import logging
+import re
+import timeit
+
+from configobj import ConfigObj
+from lxml import etree
+
+from publishers.omnifocus import (COMPLETED, OmniFocus, get_context,
+                                  get_project, mk_dict, ns)
+
+NUMBER = 200
+
+
+def regex_read_task(omnifocus, element):
+    '''
+    The old implementation: a regex per child tag and a walk up the tree
+    (twice over for the context) for every task
+    '''
+    saved = out = None
+    for child in element.iterchildren():
+        if re.match('.*name$', child.tag):
+            name = child.text.strip()
+            context = [x for x in get_context(child) if x]
+            project = [x for x in get_project(child) if x]
+            saved = (name, context, project)
+        elif re.match('.*completed$', child.tag):
+            completed = child.text.strip()
+            context = get_context(child)
+            foo = child.xpath('following-sibling::of:estimated-minutes',
+                              namespaces=ns)
+            if foo:
+                estimated_minutes = foo[0].text.strip()
+            else:
+                estimated_minutes = omnifocus.config['default_duration']
+            out = mk_dict(
+                project=project, context=context, task=name,
+                dateCompleted=completed,
+                estimatedMinutes=estimated_minutes.strip(),
+                disposition="completed")
+    return saved, out
+
+
+def documents():
+    '''
+    The names of the OmniFocus documents in test_data
+    '''
+    names = list()
+    for filename in sorted(glob.glob('test_data/*.xml')):
+        root = etree.parse(filename).getroot()
+        if root.tag == '{{{}}}omnifocus'.format(ns['of']):
+            names.append(filename)
+    return names
+
+
+def main():
+    # time the extraction, not the log file:
+    logging.getLogger('m6').setLevel(logging.WARNING)
+    omnifocus = OmniFocus(ConfigObj('test_data/config')['omnifocus'])
+    # the benchmark documents are older than any window:
+    omnifocus.all_dates = True
+    filenames = documents()
+
+    def old():
+        results = list()
+        for filename in filenames:
+            root = etree.parse(filename).getroot()
+            results.extend(regex_read_task(omnifocus, x.getparent())[1]
+                           for x in root.iter(COMPLETED))
+        return results
+
+    def new():
+        return [output for filename in filenames
+                for _, _, _, _, output in omnifocus.read_stream(filename)]
+
+    assert old() == new()
+
+    results = list()
+    for name, func in (('parse, regex_read_task', old),
+                       ('read_stream', new)):
+        seconds = min(timeit.repeat(func, repeat=3, number=NUMBER)) / NUMBER
+        results.append(seconds)
+        print '{:<28} {:8.3f} ms'.format(name, seconds * 1000)
+    print 'speedup: {:.1f}x'.format(results[0] / results[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -3,85 +3,269 @@
 import collections
 import datetime
 import fnmatch
+import functools
+import itertools
 import json
+import logging
 import os
 import os.path
 import re
+import shelve
+import subprocess
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 from os.path import expanduser
 
 from configobj import ConfigObj
-from sh import git
 
-git = git.bake('--no-pager')
+try:
+    from publishers import git_objects
+except ImportError:
+    # run as a script (python publishers/git.py) rather than as part of
+    # the package:
+    import git_objects
 
-# this regex is intended to match strings like this:
-# 4f994a3ff5dc62e01a5967f48c5883e60a53890f (remotes/svn/foobar~1)
-# the first match should be the hash ref
-# the second match should be the ref name without the trailing tilde and
-# digits:
-HASH_NAME_RE = re.compile(r'\b([0-9a-f]{40})\s\((.*?)(~\d+)?\)')
+try:
+    from os import scandir
+except ImportError:
+    # python 2 needs the backport:
+    from scandir import scandir
 
+logger = logging.getLogger('m6')
 
-def list_of_local_repos(dirs):
+HASH_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+def as_list(value):
+    '''
+    ConfigObj only gives back a list if the value had a comma in it
+    '''
+    if value is None:
+        return list()
+    if isinstance(value, basestring):
+        return [value]
+    return list(value)
+
+
+def is_excluded(name, path, excludes):
+    for pattern in excludes:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+            return True
+    return False
+
+
+def find_repos(top, excludes=(), max_depth=None, cache=None, seen=None):
+    '''
+    Walk the tree under top and return the '.git' directories in it.
+
+    Unlike os.walk this doesn't descend any further once it finds a repo,
+    skips directories matching any of the exclude globs (matched against
+    the name and the full path) and stops at max_depth levels below top.
+
+    cache maps a directory to (mtime, subdirectories) from an earlier walk;
+    a directory whose mtime hasn't changed isn't listed again. Every
+    directory visited is recorded in seen (which may be the same dict).
+    '''
+    cache = cache if cache is not None else dict()
+    seen = seen if seen is not None else dict()
+    git_repos = list()
+    stack = [(top, 0)]
+
+    while stack:
+        path, depth = stack.pop()
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        cached = cache.get(path)
+        if cached and cached[0] == mtime:
+            subdirs = cached[1]
+        else:
+            try:
+                subdirs = sorted(x.name for x in scandir(path)
+                                 if x.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+        seen[path] = (mtime, subdirs)
+
+        if '.git' in subdirs:
+            git_repos.append(os.path.join(path, '.git'))
+            continue
+        if max_depth is not None and depth >= max_depth:
+            continue
+        # push in reverse so they come off the stack in sorted order:
+        for name in reversed(subdirs):
+            child = os.path.join(path, name)
+            if not is_excluded(name, child, excludes):
+                stack.append((child, depth + 1))
+
+    return git_repos
+
+
+def list_of_local_repos(dirs, excludes=(), max_depth=None, cache=None):
+    '''
+    Find the git repos under each of dirs. If a cache dict is given it's
+    used to skip listing unchanged directories and is then replaced with
+    the directories seen on this walk.
+    '''
     git_repos = list()
+    seen = dict()
     for dir in dirs:
-        for root, dirnames, filenames in os.walk(os.path.expanduser(dir)):
-            for filename in fnmatch.filter(dirnames, '.git'):
-                git_repos.append(os.path.join(root, filename))
+        git_repos.extend(find_repos(os.path.expanduser(dir), excludes,
+                                    max_depth, cache, seen))
+    if cache is not None:
+        cache.clear()
+        cache.update(seen)
     return git_repos
 
 
-def log(repo, fields, author, days=7):
+def ref_tips(repo):
+    '''
+    Return a dictionary of ref name to commit hash for every ref in a repo.
+    The files are read directly so that finding out whether a repo has
+    changed doesn't cost a git process.
+    '''
+    tips = dict()
+    packed_refs = os.path.join(repo, 'packed-refs')
+    if os.path.exists(packed_refs):
+        for line in open(packed_refs, 'r'):
+            # skip the header and the peeled values of annotated tags:
+            if line.startswith(('#', '^')):
+                continue
+            commit_hash, _, name = line.strip().partition(' ')
+            tips[name] = commit_hash
+    # loose refs take precedence over packed ones:
+    for root, dirnames, filenames in os.walk(os.path.join(repo, 'refs')):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            commit_hash = open(path, 'r').read().strip()
+            # symbolic refs (like remotes/origin/HEAD) point at a ref
+            # that's already counted:
+            if HASH_RE.match(commit_hash):
+                tips[os.path.relpath(path, repo)] = commit_hash
+    head = os.path.join(repo, 'HEAD')
+    if os.path.exists(head):
+        commit_hash = open(head, 'r').read().strip()
+        if HASH_RE.match(commit_hash):
+            tips['HEAD'] = commit_hash
+    return tips
+
+
+def split_records(lines, separator=b'\x1e'):
+    '''
+    Join lines of output back together into the records ended by separator,
+    yielding each record as soon as it's complete
+    '''
+    pending = list()
+    for line in lines:
+        while separator in line:
+            head, line = line.split(separator, 1)
+            pending.append(head)
+            yield b''.join(pending)
+            pending = list()
+        pending.append(line)
+    tail = b''.join(pending)
+    if tail.strip():
+        yield tail
+
+
+class GitError(Exception):
+
+    def __init__(self, message, stderr):
+        super(GitError, self).__init__(message)
+        self.stderr = stderr
+
+
+def iter_log(repo, fields, author, days=7, exclude=None, refs=None):
+    '''
+    Generate the log entries for a repo one at a time as git writes them,
+    so that only one commit's output is held at once. refs is a list of
+    the ref names to walk; all of them are walked if it's None.
+    '''
+    if refs is not None and not refs:
+        return
 
 # idea borrowed from here for delimiters:
 # http://blog.lost-theory.org/post/how-to-parse-git-log-output/
-    log_format = '%x1f'.join(fields.values()) + '%x1e'
+    # the last field is the ref each commit was reached from during the
+    # walk; it's used to attribute commits to a branch without having to
+    # run the output through 'git name-rev':
+    log_format = '%x1f'.join(fields.values() + ['%S']) + '%x1e'
     date = datetime.date.today() - datetime.timedelta(days=days)
-#    name_rev = git('--git-dir', repo, 'name-rev', '--stdin')
+    args = ['git', '--no-pager', '--git-dir', repo, 'log']
+    # leave out anything reachable from these commits; '^' is used rather
+    # than '--not' because '--not' would also negate '--all':
+    args.extend('^{}'.format(x) for x in exclude or list())
+    if days != 0:
+        args.append('--after={}'.format(date))
+    args.extend(['--format={}'.format(log_format),
+                 '--author={}'.format(author)])
+    if refs is None:
+        args.append('--all')
+    else:
+        args.extend(refs)
+    # so that a ref name can't be taken for a path:
+    args.append('--')
+
+    # this uses a pipe rather than sh so that git is held up while the
+    # output is being parsed instead of it all being queued in memory:
+    stderr = tempfile.TemporaryFile()
+    command = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=stderr)
     try:
-        if days == 0:
-            command = git(git('--git-dir', repo, 'log', format=log_format,
-                              author=author, all=True),
-                          '--git-dir', repo, 'name-rev', '--stdin'
-                          )
-        else:
-            command = git(git('--git-dir', repo, 'log',
-                          after=date,
-                          format=log_format,
-                          author=author,
-                          all=True),
-                          '--git-dir', repo, 'name-rev', '--stdin'
-                          )
-    except Exception as e:
-        # this is the error message if it's a newly created repo with
-        # no commits. it doesn't seem to my like 'git log' should report
-        # an error here.  Also this is brittle if the error message changes:
-        if e.stderr == 'fatal: bad default revision \'HEAD\'\n':
-            return list()
-        raise e
-    if command.stdout == '':
-        return list()
-    parsed = command.stdout.strip('\n\x1e').split("\x1e")
-    parsed = [x.strip().split("\x1f") for x in parsed]
-    # convert to a dictionary with field names as keys:
-    log_entries = [dict(zip(fields.keys(), x)) for x in parsed]
-    for entry in log_entries:
-        # extract ref name and hash:
-        matches = re.match(HASH_NAME_RE, entry['commit_hash'])
-        entry['commit_hash'] = matches.group(1)
-        entry['branch'] = os.path.basename(matches.group(2))
-        entry['commit_message'] = entry['commit_message'].rstrip()
-    return log_entries
+        lines = iter(command.stdout.readline, b'')
+        for record in split_records(lines, separator=b'\x1e'):
+            record = record.decode('utf-8', 'replace').strip()
+            if not record:
+                continue
+            values = record.split(u'\x1f')
+            # convert to a dictionary with field names as keys:
+            entry = dict(zip(fields.keys(), values[:-1]))
+            # 'refs/remotes/svn/foobar' -> 'foobar':
+            entry['branch'] = os.path.basename(values[-1])
+            entry['commit_message'] = entry['commit_message'].rstrip()
+            yield entry
+    finally:
+        if command.poll() is None:
+            # the caller stopped early:
+            command.kill()
+        command.stdout.close()
+        command.wait()
+    stderr.seek(0)
+    error = stderr.read().decode('utf-8', 'replace')
+    stderr.close()
+    # this is the error message if it's a newly created repo with
+    # no commits. it doesn't seem to my like 'git log' should report
+    # an error here.  Also this is brittle if the error message changes:
+    if command.returncode and \
+            error != 'fatal: bad default revision \'HEAD\'\n':
+        raise GitError('git log failed in {}: {}'.format(repo, error), error)
+
+
+def log(repo, fields, author, days=7, exclude=None, refs=None):
+    return list(iter_log(repo, fields, author, days=days, exclude=exclude,
+                         refs=refs))
+
+
+def as_text(value):
+    '''
+    Decode bytes as UTF-8 the way the output of git log is, so that they
+    can be joined with what it gives back
+    '''
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
 
 
 def add_fields(entries, repo, config):
 
-    description = open('{}/description'.format(repo), 'r').read().rstrip()
+    description = as_text(
+        open('{}/description'.format(repo), 'r').read()).rstrip()
 
-    repo_name = os.path.basename(repo.replace('/.git', ''))
+    repo_name = as_text(os.path.basename(repo.replace('/.git', '')))
 
-    if not description.startswith('Unnamed repository'):
-        repo_name = '{} ({})'.format(repo_name, description)
+    if not description.startswith(u'Unnamed repository'):
+        repo_name = u'{} ({})'.format(repo_name, description)
 
     # add the name of the repo:
     [x.setdefault('repo_name', repo_name) for x in entries]
@@ -102,7 +286,217 @@ def add_fields(entries, repo, config):
     return entries
 
 
-def go(config):
+def select_refs(repo, tips, include=(), exclude=(), days=None):
+    '''
+    Return the part of tips (from ref_tips()) worth walking: the refs
+    matching one of the include globs (if there are any) and none of the
+    exclude globs and, if days is given, whose tip was committed in the
+    last that many days. Commits only reachable from a stale ref are at
+    least as old as its tip, so they'd be outside the window anyway.
+    '''
+    selected = dict()
+    for name, commit_hash in tips.items():
+        if include and not any(fnmatch.fnmatch(name, x) for x in include):
+            continue
+        if any(fnmatch.fnmatch(name, x) for x in exclude):
+            continue
+        selected[name] = commit_hash
+    if days is None:
+        return selected
+
+    since = time.time() - days * 24 * 60 * 60
+    try:
+        store = git_objects.Repository(repo)
+        try:
+            for name, commit_hash in list(selected.items()):
+                commit_hash = store.peel(commit_hash)
+                if commit_hash is None or \
+                        store.commit(commit_hash).committer.timestamp < since:
+                    del selected[name]
+        finally:
+            store.close()
+    except (git_objects.GitReadError, IOError, OSError) as e:
+        # walking a few more refs than needed is harmless:
+        logger.debug('not pruning refs in {}: {}'.format(repo, e))
+    return selected
+
+
+def read_log(repo, fields, config, exclude=None, tips=None, refs=None):
+    '''
+    Run log() for a repo, or read the objects in-process if the [git]
+    backend is 'native' (falling back to git for anything that reader
+    can't handle). refs is the subset of tips to walk, or None for all.
+    '''
+    # TODO: days=0 was added here so that a test would pass
+    # for a pre-contructed git repo; instead a git repo
+    # should be created on-the-fly for the test so that
+    # we can only query 7 days here or some shorter period:
+    if config.get('backend', 'git') == 'native':
+        try:
+            if refs is None:
+                refs = tips if tips is not None else ref_tips(repo)
+            return git_objects.log(repo, refs, fields, days=0,
+                                   author=config['author'], exclude=exclude)
+        except (git_objects.GitReadError, IOError, OSError) as e:
+            logger.debug('reading {} with git instead: {}'.format(repo, e))
+    return log(repo=repo, fields=fields, days=0, author=config['author'],
+               exclude=exclude, refs=sorted(refs) if refs is not None else None)
+
+
+def process_repo(repo, fields, config, marks=None, shared=None):
+    '''
+    Return the entries for a single repo. If marks is given it holds the
+    ref tips seen for each repo on the last run; a repo whose refs haven't
+    moved is skipped and otherwise only commits that weren't reachable
+    from the old tips are read. shared is a list of commits already read
+    from another repo whose history isn't read again.
+    '''
+    exclude = None
+    tips = None
+    refs = None
+    if marks is not None:
+        tips = ref_tips(repo)
+        previous = marks.get(repo)
+        if previous == tips:
+            return list()
+        if previous:
+            exclude = sorted(set(previous.values()))
+    if shared:
+        exclude = sorted(set(exclude or list()) | set(shared))
+
+    include_refs = as_list(config.get('include_refs'))
+    exclude_refs = as_list(config.get('exclude_refs'))
+    ref_days = config.get('ref_days')
+    if include_refs or exclude_refs or ref_days is not None:
+        if tips is None:
+            tips = ref_tips(repo)
+        refs = select_refs(
+            repo, tips, include_refs, exclude_refs,
+            float(ref_days) if ref_days is not None else None)
+
+    try:
+        log_entries = read_log(repo, fields, config, exclude, tips, refs)
+    except GitError:
+        if not exclude:
+            raise
+        # an old tip has gone away (e.g. the branch was rewritten and
+        # garbage collected), so read the whole history again:
+        log_entries = read_log(repo, fields, config, tips=tips, refs=refs)
+
+    if marks is not None:
+        marks[repo] = tips
+    return add_fields(log_entries, repo, config)
+
+
+def as_bool(value):
+    if isinstance(value, basestring):
+        return value.lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+def store_key(repo):
+    '''
+    Return the object store a repo's history is kept in; repos that
+    borrow objects from another through objects/info/alternates (e.g. made
+    with 'git clone --shared' or --reference) get that store's path
+    '''
+    dirs = git_objects.object_dirs(
+        os.path.join(git_objects.common_dir(repo), 'objects'))
+    return os.path.realpath(dirs[-1])
+
+
+def group_repos(repos):
+    '''
+    Group repos that share history: those that share an object store or
+    are exact copies of one another (the same ref tips), or are linked
+    through others that do. Groups and the repos in them keep their order.
+    '''
+    # union-find over the positions of the repos, with the first one
+    # standing for its group:
+    parent = list(range(len(repos)))
+
+    def find(index):
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    first = dict()
+    for index, repo in enumerate(repos):
+        tips = tuple(sorted(set(ref_tips(repo).values())))
+        keys = [('store', store_key(repo))]
+        if tips:
+            keys.append(('tips', tips))
+        for key in keys:
+            roots = sorted([find(index), find(first.setdefault(key, index))])
+            parent[roots[1]] = roots[0]
+
+    groups = collections.OrderedDict()
+    for index, repo in enumerate(repos):
+        groups.setdefault(find(index), list()).append(repo)
+    return groups.values()
+
+
+def process_group(repos, fields, config, marks=None):
+    '''
+    Read repos that share history one after another, each one leaving
+    out the commits reachable from the refs of those before it and, if
+    marks is given, from the tips the others had on the last run
+    '''
+    entries = list()
+    shared = set()
+    seen_tips = list()
+    for repo in repos:
+        refs = ref_tips(repo)
+        tips = sorted(set(refs.values()))
+        if tips and tips in seen_tips:
+            # an exact copy of a repo that's already been read; its tips
+            # are still marked so that a later run doesn't read all of it:
+            if marks is not None:
+                marks[repo] = refs
+            continue
+        seen_tips.append(tips)
+        # what's already been reported from the rest of the group (which
+        # may include a clone of this repo read on an earlier run):
+        reported = set(shared)
+        if marks is not None:
+            for other in repos:
+                if other != repo and marks.get(other):
+                    reported.update(marks[other].values())
+        available = list()
+        if reported:
+            try:
+                store = git_objects.Repository(repo)
+                try:
+                    available = sorted(x for x in reported
+                                       if store.has_object(x))
+                finally:
+                    store.close()
+            except (git_objects.GitReadError, IOError, OSError) as e:
+                logger.debug('not sharing history with {}: {}'.format(repo, e))
+        entries.extend(process_repo(repo, fields, config, marks, available))
+        shared.update(tips)
+    return entries
+
+
+def dedupe_entries(entries):
+    '''
+    Drop the entries for commits that have already been seen in another
+    repo (clones of the same project)
+    '''
+    seen = set()
+    new_list = list()
+    for entry in entries:
+        commit_hash = entry.get('commit_hash')
+        if commit_hash in seen:
+            continue
+        if commit_hash:
+            seen.add(commit_hash)
+        new_list.append(entry)
+    return new_list
+
+
+def go(config, state=None):
 
 # define the fields of git-log output I want:
     fields = collections.OrderedDict()
@@ -112,25 +506,66 @@ def go(config):
     fields['commit_message'] = '%B'
     fields['commit_hash'] = '%H'
 
-    local_repo_list = list_of_local_repos(config['repo_dirs'])
-    entries = list()
+    max_depth = config.get('max_depth')
+    if max_depth is not None:
+        max_depth = int(max_depth)
+    cache = None
+    marks = None
+    if state is not None:
+        cache = state.setdefault('discovery', dict())
+        marks = state.setdefault('marks', dict())
+    # sort so that the output order doesn't depend on the filesystem or on
+    # which worker finishes first:
+    local_repo_list = sorted(list_of_local_repos(
+        config['repo_dirs'], excludes=as_list(config.get('exclude')),
+        max_depth=max_depth, cache=cache))
+    dedupe = as_bool(config.get('dedupe', True))
+    if dedupe:
+        # repos sharing an object store are read together so that their
+        # common history is only read once:
+        work = group_repos(local_repo_list)
+        extract = functools.partial(process_group, fields=fields,
+                                    config=config, marks=marks)
+    else:
+        work = local_repo_list
+        extract = functools.partial(process_repo, fields=fields,
+                                    config=config, marks=marks)
+
+    # the work is almost all waiting on git subprocesses, so threads are
+    # enough to run repos in parallel:
+    workers = int(config.get('workers', 1))
+    if workers > 1 and len(work) > 1:
+        pool = ThreadPool(min(workers, len(work)))
+        try:
+            # map() returns results in the order of the input list:
+            results = pool.map(extract, work)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [extract(x) for x in work]
 
-    for repo in local_repo_list:
-        # TODO: days=0 was added here so that a test would pass
-        # for a pre-contructed git repo; instead a git repo
-        # should be created on-the-fly for the test so that
-        # we can only query 7 days here or some shorter period:
-        log_entries = log(repo=repo, fields=fields, days=0,
-                          author=config['author'])
-        log_entries = add_fields(log_entries, repo, config)
-        entries.extend(log_entries)
+    if marks is not None:
+        # forget repos that have gone away:
+        for repo in set(marks) - set(local_repo_list):
+            del marks[repo]
 
+    entries = list(itertools.chain.from_iterable(results))
+    if dedupe:
+        entries = dedupe_entries(entries)
     return entries
 
 if __name__ == '__main__':
 
     config = ConfigObj(expanduser('~/.m6rc'))
+    config = config['git']
+    state = None
+    if 'app_dir' in config:
+        filename = '{}/git-state.shelve'.format(expanduser(config['app_dir']))
+        state = shelve.open(filename, flag='c', writeback=True)
 
-    entries = go(config['git'])
+    entries = go(config, state)
+    if state is not None:
+        state.close()
 
     print json.dumps(entries, indent=2)
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+'''
+Read commits straight out of a git directory (loose objects, packs and
+alternates) so that scanning a repo doesn't cost any git processes.
+
+Only enough of git is implemented to reproduce publishers.git.log(); for
+anything else GitReadError is raised and the caller should fall back to
+running git.
+'''
+
+import binascii
+import collections
+import datetime
+import glob
+import heapq
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+
+OBJ_COMMIT = 1
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+
+TYPE_NAMES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+
+# how much compressed data to hand zlib at a time when inflating from a
+# pack:
+CHUNK_SIZE = 4096
+
+# number of delta bases kept around per pack:
+BASE_CACHE_SIZE = 64
+
+# e.g. 'First Last <first.last@example.com> 1368660782 -0500':
+PERSON_RE = re.compile(r'^(.*?) ?<(.*)> (\d+) ([+-])(\d\d)(\d\d)$')
+
+Person = collections.namedtuple(
+    'Person', ['name', 'email', 'timestamp', 'offset', 'tz'])
+
+Commit = collections.namedtuple(
+    'Commit', ['hash', 'parents', 'author', 'committer', 'message'])
+
+
+class GitReadError(Exception):
+    pass
+
+
+def byte_at(data, pos):
+    return bytearray(data[pos:pos + 1])[0]
+
+
+class PackIndex(object):
+    '''
+    A version 2 pack index (the only kind git has written since 1.5.2)
+    '''
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:4] != b'\xfftOc' or \
+                struct.unpack('>I', self.data[4:8])[0] != 2:
+            self.close()
+            raise GitReadError('unsupported pack index {}'.format(path))
+        self.fanout = struct.unpack('>256I', self.data[8:1032])
+        count = self.fanout[-1]
+        self.names_at = 1032
+        # the CRCs come after the names but aren't needed:
+        self.offsets_at = self.names_at + 24 * count
+        self.large_offsets_at = self.offsets_at + 4 * count
+
+    def find(self, binsha):
+        '''
+        Return the offset into the pack of an object, or None
+        '''
+        first = bytearray(binsha)[0]
+        low = self.fanout[first - 1] if first else 0
+        high = self.fanout[first]
+        while low < high:
+            middle = (low + high) // 2
+            pos = self.names_at + 20 * middle
+            name = self.data[pos:pos + 20]
+            if name < binsha:
+                low = middle + 1
+            elif name > binsha:
+                high = middle
+            else:
+                return self.offset(middle)
+        return None
+
+    def offset(self, number):
+        pos = self.offsets_at + 4 * number
+        offset = struct.unpack('>I', self.data[pos:pos + 4])[0]
+        if offset & 0x80000000:
+            pos = self.large_offsets_at + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack('>Q', self.data[pos:pos + 8])[0]
+        return offset
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class Pack(object):
+
+    def __init__(self, path):
+        self.index = PackIndex(path[:-len('.pack')] + '.idx')
+        self.file = open(path, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.bases = dict()
+
+    def inflate(self, pos, size):
+        decompressor = zlib.decompressobj()
+        out = list()
+        length = 0
+        while length < size or not out:
+            chunk = self.data[pos:pos + CHUNK_SIZE]
+            if not chunk:
+                raise GitReadError('truncated pack')
+            pos += CHUNK_SIZE
+            piece = decompressor.decompress(chunk)
+            out.append(piece)
+            length += len(piece)
+        return b''.join(out)[:size]
+
+    def read(self, offset, store):
+        '''
+        Return (type number, data) of the object at offset, resolving
+        deltas against their bases
+        '''
+        if offset in self.bases:
+            return self.bases[offset]
+
+        pos = offset
+        c = byte_at(self.data, pos)
+        pos += 1
+        kind = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        while c & 0x80:
+            c = byte_at(self.data, pos)
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+
+        if kind == OBJ_OFS_DELTA:
+            c = byte_at(self.data, pos)
+            pos += 1
+            base_offset = c & 0x7f
+            while c & 0x80:
+                c = byte_at(self.data, pos)
+                pos += 1
+                base_offset = ((base_offset + 1) << 7) | (c & 0x7f)
+            kind, base = self.read(offset - base_offset, store)
+            result = (kind, apply_delta(base, self.inflate(pos, size)))
+        elif kind == OBJ_REF_DELTA:
+            base_hash = binascii.hexlify(self.data[pos:pos + 20]).decode(
+                'ascii')
+            kind, base = store.read_raw(base_hash)
+            result = (kind, apply_delta(base, self.inflate(pos + 20, size)))
+        else:
+            result = (kind, self.inflate(pos, size))
+
+        if len(self.bases) >= BASE_CACHE_SIZE:
+            self.bases.clear()
+        self.bases[offset] = result
+        return result
+
+    def close(self):
+        self.index.close()
+        self.data.close()
+        self.file.close()
+
+
+def read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+
+def apply_delta(base, delta):
+    delta = bytearray(delta)
+    source_size, pos = read_varint(delta, 0)
+    target_size, pos = read_varint(delta, pos)
+    if source_size != len(base):
+        raise GitReadError('delta doesn\'t match its base')
+    out = list()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy a range of the base:
+            offset = 0
+            size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            # insert literal data:
+            out.append(bytes(delta[pos:pos + op]))
+            pos += op
+        else:
+            raise GitReadError('bad delta opcode')
+    result = b''.join(out)
+    if len(result) != target_size:
+        raise GitReadError('delta produced the wrong size')
+    return result
+
+
+def common_dir(git_dir):
+    '''
+    The git directory of a linked worktree keeps its objects and most refs
+    in the main repository's, which 'commondir' points at
+    '''
+    commondir = os.path.join(git_dir, 'commondir')
+    if os.path.exists(commondir):
+        path = open(commondir, 'r').read().strip()
+        return os.path.normpath(os.path.join(git_dir, path))
+    return git_dir
+
+
+def object_dirs(object_dir, depth=0):
+    '''
+    Return object_dir and, recursively, any object stores it borrows from
+    via objects/info/alternates
+    '''
+    dirs = [object_dir]
+    alternates = os.path.join(object_dir, 'info', 'alternates')
+    # git itself gives up after 5 levels:
+    if depth < 5 and os.path.exists(alternates):
+        for line in open(alternates, 'r'):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            path = os.path.normpath(os.path.join(object_dir, line))
+            dirs.extend(object_dirs(path, depth + 1))
+    return dirs
+
+
+class Repository(object):
+
+    def __init__(self, git_dir):
+        self.git_dir = git_dir
+        config = os.path.join(git_dir, 'config')
+        if os.path.exists(config):
+            text = open(config, 'r').read().lower()
+            # newer repository formats that this doesn't understand:
+            if re.search(r'objectformat\s*=\s*(?!sha1)', text) or \
+                    re.search(r'refstorage\s*=\s*(?!files)', text):
+                raise GitReadError('unsupported repository format')
+        self.object_dirs = object_dirs(
+            os.path.join(common_dir(git_dir), 'objects'))
+        self.packs = list()
+        for object_dir in self.object_dirs:
+            for path in sorted(glob.glob(
+                    os.path.join(object_dir, 'pack', '*.pack'))):
+                self.packs.append(Pack(path))
+        self.commits = dict()
+
+    def has_object(self, commit_hash):
+        for object_dir in self.object_dirs:
+            if os.path.exists(os.path.join(object_dir, commit_hash[:2],
+                                           commit_hash[2:])):
+                return True
+        binsha = binascii.unhexlify(commit_hash)
+        return any(pack.index.find(binsha) is not None for pack in self.packs)
+
+    def read_raw(self, commit_hash):
+        '''
+        Return (type number, data) for an object
+        '''
+        for object_dir in self.object_dirs:
+            path = os.path.join(object_dir, commit_hash[:2], commit_hash[2:])
+            if os.path.exists(path):
+                raw = zlib.decompress(open(path, 'rb').read())
+                header, _, data = raw.partition(b'\0')
+                kind = header.split(b' ')[0].decode('ascii')
+                for number, name in TYPE_NAMES.items():
+                    if name == kind:
+                        return number, data
+        binsha = binascii.unhexlify(commit_hash)
+        for pack in self.packs:
+            offset = pack.index.find(binsha)
+            if offset is not None:
+                return pack.read(offset, self)
+        raise GitReadError('object {} not found'.format(commit_hash))
+
+    def peel(self, commit_hash):
+        '''
+        Follow annotated tags to what they point at; returns None if that
+        isn't a commit
+        '''
+        kind, data = self.read_raw(commit_hash)
+        while kind == OBJ_TAG:
+            commit_hash = data.split(b'\n', 1)[0].split(b' ')[1]
+            commit_hash = commit_hash.decode('ascii')
+            kind, data = self.read_raw(commit_hash)
+        if kind != OBJ_COMMIT:
+            return None
+        return commit_hash
+
+    def commit(self, commit_hash):
+        if commit_hash in self.commits:
+            return self.commits[commit_hash]
+        kind, data = self.read_raw(commit_hash)
+        if kind != OBJ_COMMIT:
+            raise GitReadError('{} is not a commit'.format(commit_hash))
+        commit = parse_commit(commit_hash, data)
+        self.commits[commit_hash] = commit
+        return commit
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+
+
+def parse_person(text):
+    match = PERSON_RE.match(text)
+    if not match:
+        raise GitReadError('can\'t parse {}'.format(text))
+    name, email, timestamp, sign, hours, minutes = match.groups()
+    offset = (int(hours) * 60 + int(minutes)) * 60
+    if sign == '-':
+        offset = -offset
+    return Person(name, email, int(timestamp), offset,
+                  '{}{}{}'.format(sign, hours, minutes))
+
+
+def parse_commit(commit_hash, data):
+    text = data.decode('utf-8', 'replace')
+    header, _, message = text.partition(u'\n\n')
+    parents = list()
+    author = committer = None
+    for line in header.split(u'\n'):
+        if line.startswith(u'parent '):
+            parents.append(line[len(u'parent '):])
+        elif line.startswith(u'author '):
+            author = parse_person(line[len(u'author '):])
+        elif line.startswith(u'committer '):
+            committer = parse_person(line[len(u'committer '):])
+    if author is None or committer is None:
+        raise GitReadError('can\'t parse commit {}'.format(commit_hash))
+    return Commit(commit_hash, parents, author, committer, message)
+
+
+def iso_date(person):
+    '''
+    The same as git's %ai/%ci, e.g. '2013-05-15 18:33:02 -0500'
+    '''
+    local = datetime.datetime.utcfromtimestamp(
+        person.timestamp + person.offset)
+    return '{} {}'.format(local.strftime('%Y-%m-%d %H:%M:%S'), person.tz)
+
+
+def short_ref(name):
+    for prefix, replacement in (('refs/heads/', ''),
+                                ('refs/remotes/', ''),
+                                ('refs/tags/', 'tag: ')):
+        if name.startswith(prefix):
+            return replacement + name[len(prefix):]
+    return name
+
+
+# the git log format placeholders that are understood; each takes the
+# commit and the names of the refs pointing at it:
+PLACEHOLDERS = {
+    '%H': lambda c, refs: c.hash,
+    '%P': lambda c, refs: ' '.join(c.parents),
+    '%an': lambda c, refs: c.author.name,
+    '%ae': lambda c, refs: c.author.email,
+    '%ai': lambda c, refs: iso_date(c.author),
+    '%at': lambda c, refs: str(c.author.timestamp),
+    '%cn': lambda c, refs: c.committer.name,
+    '%ce': lambda c, refs: c.committer.email,
+    '%ci': lambda c, refs: iso_date(c.committer),
+    '%ct': lambda c, refs: str(c.committer.timestamp),
+    '%s': lambda c, refs: c.message.split(u'\n\n', 1)[0].replace(u'\n', u' '),
+    '%B': lambda c, refs: c.message,
+    '%d': lambda c, refs: ' ({})'.format(
+        ', '.join(short_ref(x) for x in refs)) if refs else '',
+}
+
+
+def walk(store, tips, exclude, since=None):
+    '''
+    Yield (commit, source ref) newest first for every commit reachable from
+    tips (a dictionary of ref name to hash) but not from any of the
+    exclude hashes, like 'git log --all ^<exclude>...'.
+    '''
+    # refs are used in the same order as 'git log --all' so that each
+    # commit is attributed to the same ref as git's %S:
+    names = sorted(x for x in tips if x != 'HEAD')
+    if 'HEAD' in tips:
+        names.append('HEAD')
+
+    heap = list()
+    uninteresting = dict()
+    source = dict()
+    done = set()
+    counter = [0]
+    # how many of the commits in the heap aren't excluded:
+    interesting = [0]
+
+    def push(commit_hash):
+        commit = store.commit(commit_hash)
+        counter[0] += 1
+        if not uninteresting[commit_hash]:
+            interesting[0] += 1
+        heapq.heappush(heap, (-commit.committer.timestamp, counter[0],
+                              commit_hash))
+
+    def mark_uninteresting(commit_hash):
+        stack = [commit_hash]
+        while stack:
+            commit_hash = stack.pop()
+            queued = uninteresting.get(commit_hash)
+            if queued:
+                continue
+            uninteresting[commit_hash] = True
+            if commit_hash in done:
+                stack.extend(store.commit(commit_hash).parents)
+            elif queued is None:
+                push(commit_hash)
+            else:
+                # it's waiting in the heap, no longer interesting:
+                interesting[0] -= 1
+
+    for commit_hash in exclude:
+        commit_hash = store.peel(commit_hash)
+        if commit_hash:
+            mark_uninteresting(commit_hash)
+    for name in names:
+        commit_hash = store.peel(tips[name])
+        if commit_hash and commit_hash not in uninteresting:
+            uninteresting[commit_hash] = False
+            source[commit_hash] = name
+            push(commit_hash)
+
+    # everything is walked before anything is returned because a commit
+    # can turn out to be reachable from an excluded one after it's been
+    # seen:
+    output = list()
+    # stop once only excluded history is left:
+    while heap and interesting[0]:
+        timestamp, _, commit_hash = heapq.heappop(heap)
+        if not uninteresting[commit_hash]:
+            interesting[0] -= 1
+        if commit_hash in done:
+            continue
+        done.add(commit_hash)
+        commit = store.commit(commit_hash)
+        if uninteresting[commit_hash]:
+            for parent in commit.parents:
+                mark_uninteresting(parent)
+            continue
+        output.append(commit)
+        if since is not None and -timestamp < since:
+            continue
+        for parent in commit.parents:
+            if parent not in uninteresting:
+                uninteresting[parent] = False
+                source[parent] = source[commit_hash]
+                push(parent)
+
+    for commit in output:
+        if not uninteresting[commit.hash]:
+            yield commit, source[commit.hash]
+
+
+def log(repo, tips, fields, author, days=7, exclude=None):
+    '''
+    The in-process equivalent of publishers.git.log(); tips is the
+    dictionary returned by publishers.git.ref_tips().
+    '''
+    for value in fields.values():
+        if value not in PLACEHOLDERS:
+            raise GitReadError('unsupported format {}'.format(value))
+    since = None
+    if days != 0:
+        date = datetime.date.today() - datetime.timedelta(days=days)
+        since = time.mktime(date.timetuple())
+    author_re = re.compile(author)
+
+    refs = dict()
+    store = Repository(repo)
+    try:
+        for name, commit_hash in tips.items():
+            refs.setdefault(store.peel(commit_hash), list()).append(name)
+        log_entries = list()
+        for commit, ref in walk(store, tips, exclude or list(), since):
+            if since is not None and commit.committer.timestamp < since:
+                continue
+            if not author_re.search(u'{} <{}>'.format(commit.author.name,
+                                                      commit.author.email)):
+                continue
+            entry = dict((key, PLACEHOLDERS[value](commit,
+                                                   refs.get(commit.hash)))
+                         for key, value in fields.items())
+            # 'refs/remotes/svn/foobar' -> 'foobar':
+            entry['branch'] = os.path.basename(ref)
+            entry['commit_message'] = entry['commit_message'].rstrip()
+            log_entries.append(entry)
+    finally:
+        store.close()
+    return log_entries
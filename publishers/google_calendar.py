@@ -3,12 +3,17 @@
 import argparse
 from os.path import expanduser
 import httplib2
+import itertools
 import json
 from datetime import datetime
 from datetime import timedelta
 import pytz
 import dateutil.parser
 import re
+import shelve
+import threading
+import urllib
+from multiprocessing.pool import ThreadPool
 
 from configobj import ConfigObj
 from oauth2client.file import Storage
@@ -24,8 +29,30 @@ end_query = end_query.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 utc = pytz.timezone('UTC')
 
+EVENTS_URL = 'https://www.googleapis.com/calendar/v3/calendars/{}/events'
+
+# a full sync covers this many days ahead so that the window can move on
+# for a while before another full sync is needed:
+SYNC_AHEAD_DAYS = 30
+
+# only ask for what the filters, the transforms and the subscribers use:
+FIELDS = ('items(id,iCalUID,summary,status,visibility,start,end,organizer,'
+          'attendees(email,displayName,self,responseStatus,comment)),'
+          'nextPageToken,nextSyncToken')
+
+# the most events the API will return in one page:
+MAX_RESULTS = 2500
+
+
+# each thread keeps its own connection open (httplib2 isn't thread safe):
+local = threading.local()
 
-def do_google_oauth_stuff():
+
+class SyncTokenExpired(Exception):
+    pass
+
+
+def get_credentials():
 
 # Set up a Flow object to be used if we need to authenticate. This
 # sample uses OAuth 2.0, and we set up the OAuth2WebServerFlow with
@@ -52,11 +79,26 @@ def do_google_oauth_stuff():
     credentials = storage.get()
     if credentials is None or credentials.invalid is True:
         credentials = run(FLOW, storage)
+    return credentials
+
+
+def get_http(credentials):
+    '''
+    An authorized client for this thread, reused across requests so the
+    connection is kept alive (httplib2 asks for gzip on its own)
+    '''
+    if getattr(local, 'credentials', None) is not credentials:
+        local.credentials = credentials
+        local.http = credentials.authorize(httplib2.Http())
+    return local.http
+
+
+def do_google_oauth_stuff():
 
 # Create an httplib2.Http object to handle our HTTP requests and authorize it
 # with our good Credentials.
     http = httplib2.Http()
-    http = credentials.authorize(http)
+    http = get_credentials().authorize(http)
 
 # Build a service object for interacting with the API. Visit
 # the Google APIs Console
@@ -78,77 +120,69 @@ def get_date(entry, item):
         return None
 
 
-def filter_private_entries(entries):
+TAG_RE = re.compile('.*#(\S+)', re.IGNORECASE)
 
-    new_list = list()
-    for entry in entries:
-        if entry.get('visibility') == 'private':
-            continue
-        new_list.append(entry)
-    return new_list
 
+def is_public(entry):
+    return entry.get('visibility') != 'private'
 
-def filter_declined_entries(entries):
 
-    new_list = list()
+def is_not_declined(entry):
 
-    for entry in entries:
-        if entry.get('attendees'):
-            me = [x for x in entry.get('attendees') if x.get('self') is True]
-            if len(me) == 0:
-                # there's an odd case where I schedule something, but I'm
-                # not an attendee at all; ignore these:
-                continue
-            me = me[0]
-            if me['responseStatus'] == 'declined':
-                continue
-        new_list.append(entry)
+    if entry.get('attendees'):
+        me = [x for x in entry.get('attendees') if x.get('self') is True]
+        if len(me) == 0:
+            # there's an odd case where I schedule something, but I'm
+            # not an attendee at all; ignore these:
+            return False
+        if me[0]['responseStatus'] == 'declined':
+            return False
+    return True
 
-    return new_list
 
+def is_not_cancelled(entry):
+    return entry.get('status') != 'cancelled'
 
-def filter_cancelled_events(entries):
 
-    new_list = list()
-    for entry in entries:
-        if entry.get('status') == 'cancelled':
-            continue
-        new_list.append(entry)
-    return new_list
+def has_end_date(entry):
+    return entry.get('end_date', None) is not None
 
 
-def filter_no_end_date(entries):
+def filter_private_entries(entries):
+    return [x for x in entries if is_public(x)]
 
-    new_list = list()
-    for entry in entries:
-        if entry.get('end_date', None) is None:
-            continue
-        new_list.append(entry)
-    return new_list
 
+def filter_declined_entries(entries):
+    return [x for x in entries if is_not_declined(x)]
 
-def transform_data(entries, calendar_name):
 
-    new_list = list()
+def filter_cancelled_events(entries):
+    return [x for x in entries if is_not_cancelled(x)]
+
+
+def filter_no_end_date(entries):
+    return [x for x in entries if has_end_date(x)]
+
+
+def transform_entry(entry, calendar_name):
 
-    for entry in entries:
-        entry['source'] = 'calendar'
-        entry['calendar_name'] = calendar_name
-        entry['title'] = entry.get('summary')
-        entry['key'] = entry.get('iCalUID')
+    entry['source'] = 'calendar'
+    entry['calendar_name'] = calendar_name
+    entry['title'] = entry.get('summary')
+    entry['key'] = entry.get('iCalUID')
 
-        # get tag, if there is one
-        for attendee in entry.get('attendees', list()):
-            if attendee.get('email') == calendar_name:
-                if 'comment' in attendee:
-                    pattern = re.compile('.*#(\S+)', re.IGNORECASE)
-                    match = pattern.match(attendee['comment'])
-                    if match:
-                        entry['tag'] = match.group(1)
+    # get tag, if there is one
+    for attendee in entry.get('attendees', list()):
+        if attendee.get('email') == calendar_name and 'comment' in attendee:
+            match = TAG_RE.match(attendee['comment'])
+            if match:
+                entry['tag'] = match.group(1)
 
-        new_list.append(entry)
+    return entry
 
-    return new_list
+
+def transform_data(entries, calendar_name):
+    return [transform_entry(x, calendar_name) for x in entries]
 
 
 def transform_dates(calendar_item):
@@ -168,32 +202,173 @@ def process(calendar_entries, calendar_name):
 
     content = json.loads(calendar_entries)
 
-    entry_list = [transform_dates(x) for x in content['items']]
-    entry_list = filter_no_end_date(entry_list)
-    entry_list = filter_cancelled_events(entry_list)
-    entry_list = filter_private_entries(entry_list)
-    entry_list = filter_declined_entries(entry_list)
-    entry_list = transform_data(entry_list, calendar_name)
+    return process_items(content['items'], calendar_name)
 
-    return entry_list
 
+# the filters only look at what came from the API, so they run before the
+# dates are parsed:
+PREDICATES = (is_not_cancelled, is_public, is_not_declined)
 
-def go(calendar_name):
 
-    http = do_google_oauth_stuff()
+def iter_process(items, calendar_name):
+    '''
+    Filter and transform the events one at a time in a single pass
+    '''
+    for item in items:
+        if not all(predicate(item) for predicate in PREDICATES):
+            continue
+        item = transform_dates(item)
+        if not has_end_date(item):
+            continue
+        yield transform_entry(item, calendar_name)
+
 
-    resp, content = http.request(
-        "https://www.googleapis.com/calendar/v3/calendars/{}/"
-        "events?orderBy=startTime&singleEvents=true&timeMax="
-        "{}&timeMin={}".format(calendar_name, end_query, start_query), "GET")
+def process_items(items, calendar_name):
+    return list(iter_process(items, calendar_name))
 
+
+def get_events_page(http, calendar_name, params):
+
+    resp, content = http.request('{}?{}'.format(
+        EVENTS_URL.format(urllib.quote(calendar_name)),
+        urllib.urlencode(sorted(params.items()))), "GET")
+
+    # the sync token is too old to be used:
+    if resp.status == 410:
+        raise SyncTokenExpired
     if resp.status != 200:
         print resp
         print resp.status
-        print resp.content
+        print content
         raise Exception
-    bar = process(content, calendar_name)
-    return bar
+    return json.loads(content)
+
+
+def iter_pages(http, calendar_name, params):
+    '''
+    Yield each page of events as it arrives, following nextPageToken
+    '''
+    params = dict(params, fields=FIELDS, maxResults=MAX_RESULTS)
+    while True:
+        page = get_events_page(http, calendar_name, params)
+        yield page
+        if 'nextPageToken' not in page:
+            return
+        params['pageToken'] = page['nextPageToken']
+
+
+def iter_events(http, calendar_name, params):
+
+    for page in iter_pages(http, calendar_name, params):
+        for item in page.get('items', list()):
+            yield item
+
+
+def in_window(entry):
+    '''
+    Whether an event overlaps the time being queried
+    '''
+    start = get_date(entry, 'start')
+    end = get_date(entry, 'end')
+    if start is None or end is None:
+        return False
+    return end >= dateutil.parser.parse(start_query) and \
+        start <= dateutil.parser.parse(end_query)
+
+
+def sync(http, calendar_name, store):
+    '''
+    Bring store (a dictionary holding a calendar's events by id, the sync
+    token and how far ahead the last full sync went) up to date. When
+    there's a usable sync token only the events that have changed since
+    the last sync are fetched.
+    '''
+    if store.get('sync_token') and store.get('time_max', '') >= end_query:
+        events = store['events']
+        # the parameters that can go with a sync token have to be the
+        # same as the full sync's, otherwise recurring events come back as
+        # the series rather than as the instances that were stored:
+        params = {'syncToken': store['sync_token'], 'singleEvents': 'true'}
+    else:
+        events = dict()
+        time_max = (datetime.now() + timedelta(days=SYNC_AHEAD_DAYS))
+        time_max = time_max.strftime('%Y-%m-%dT%H:%M:%SZ')
+        params = {'singleEvents': 'true', 'timeMin': start_query,
+                  'timeMax': time_max}
+
+    try:
+        for page in iter_pages(http, calendar_name, params):
+            for item in page.get('items', list()):
+                if item.get('status') == 'cancelled':
+                    events.pop(item['id'], None)
+                else:
+                    events[item['id']] = item
+    except SyncTokenExpired:
+        store.clear()
+        return sync(http, calendar_name, store)
+
+    if 'syncToken' not in params:
+        store['time_max'] = time_max
+    # forget events that have dropped out of the window:
+    start = dateutil.parser.parse(start_query)
+    for key in [x for x, y in events.items()
+                if get_date(y, 'end') and get_date(y, 'end') < start]:
+        del events[key]
+    store['events'] = events
+    store['sync_token'] = page.get('nextSyncToken')
+    return events
+
+
+def fetch(http, calendar_name, store=None):
+
+    if store is not None:
+        events = sync(http, calendar_name, store)
+        items = sorted([x for x in events.values() if in_window(x)],
+                       key=lambda x: get_date(x, 'start'))
+        return process_items(items, calendar_name)
+
+    params = {'orderBy': 'startTime', 'singleEvents': 'true',
+              'timeMin': start_query, 'timeMax': end_query}
+    return process_items(iter_events(http, calendar_name, params),
+                         calendar_name)
+
+
+def go(calendar_name, state=None):
+
+    http = do_google_oauth_stuff()
+    store = None
+    if state is not None:
+        store = state.setdefault(calendar_name, dict())
+    return fetch(http, calendar_name, store)
+
+
+def go_all(calendars, state=None, workers=4):
+    '''
+    Fetch several calendars at once, each over its own kept-alive
+    connection; the entries come back in the order of the calendars
+    '''
+    credentials = get_credentials()
+
+    # the state is only touched from this thread:
+    stores = dict()
+    if state is not None:
+        stores = {x: state.setdefault(x, dict()) for x in calendars}
+
+    def extract(calendar_name):
+        return fetch(get_http(credentials), calendar_name,
+                     stores.get(calendar_name))
+
+    if workers > 1 and len(calendars) > 1:
+        pool = ThreadPool(min(workers, len(calendars)))
+        try:
+            results = pool.map(extract, calendars)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [extract(x) for x in calendars]
+
+    return list(itertools.chain.from_iterable(results))
 
 
 if __name__ == '__main__':
@@ -204,5 +379,16 @@ if __name__ == '__main__':
         description='fetch Google calendar entries and queue them')
     parsed = parser.parse_args()
     #foo = go(parsed.calendar)
-    entries = go(config['google-calendar']['calendar'])
+    config = config['google-calendar']
+    state = None
+    if 'app_dir' in config:
+        filename = '{}/calendar-state.shelve'.format(
+            expanduser(config['app_dir']))
+        state = shelve.open(filename, flag='c', writeback=True)
+    calendars = config['calendar']
+    if isinstance(calendars, basestring):
+        calendars = [calendars]
+    entries = go_all(calendars, state, int(config.get('workers', 4)))
+    if state is not None:
+        state.close()
     print json.dumps(entries, indent=2)
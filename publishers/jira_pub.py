@@ -1,14 +1,19 @@
 #!/usr/bin/env python
 
-import feedparser
+import calendar
+from io import BytesIO
 from StringIO import StringIO
 from lxml import etree
 import requests
 import json
 import re
+import shelve
+import time
 import urlparse
+from multiprocessing.pool import ThreadPool
 from os.path import expanduser
 from configobj import ConfigObj
+import dateutil.parser
 from jira.client import JIRA
 
 config = ConfigObj(expanduser('~/.m6rc'))
@@ -18,11 +23,54 @@ JIRA_HOST = config['server']
 USER = config['username']
 PASS = config['password']
 NUM_ITEMS = config['num_items']
+# how many days of the activity stream to read (and how far back the first
+# incremental sync looks):
+DAYS = int(config.get('days', 7))
+# how many requests to have going at once when worklogs need paging:
+WORKERS = int(config.get('workers', 4))
+
+# how many issue keys to look up in one search:
+BATCH_SIZE = 50
+
+# the most worklogs that can be asked for in one worklog/list request:
+WORKLOG_BATCH_SIZE = 1000
+
+ATOM_ENTRY = '{http://www.w3.org/2005/Atom}entry'
+ATOM_TITLE = '{http://www.w3.org/2005/Atom}title'
+ATOM_UPDATED = '{http://www.w3.org/2005/Atom}updated'
+
+# the title of a worklog entry is HTML like this:
+# <a ...>First Last</a> logged '0.25h' on <a ...>ABC-123 - summary</a>
+# (the key is sometimes wrapped in a <span> too) and the match should be
+# the issue key:
+LOGGED_RE = re.compile(
+    r'\blogged\b[^<]*<a\b[^>]*>(?:\s*<[^>]*>)*\s*([^\s<]+)')
+
+# the activity stream's timestamps look like 2013-05-14T19:49:58.629Z:
+UTC_TIMESTAMP_RE = re.compile(
+    r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.(\d+))?Z$')
+
+# lxml parsers can be reused, so only make one:
+HTML_PARSER = etree.HTMLParser()
+
+jira_server = None
+session = None
+
+
+def get_jira():
+    '''
+    Return the JIRA client shared by everything in this module so that the
+    login and the keep-alive connection are only set up once
+    '''
+    global jira_server
+    if jira_server is None:
+        jira_options = {'server': 'https://{}'.format(JIRA_HOST)}
+        jira_server = JIRA(jira_options, basic_auth=(USER, PASS))
+    return jira_server
 
 
 def get_recent_issues():
-    jira_options = {'server': 'https://{}'.format(JIRA_HOST)}
-    jira_server = JIRA(jira_options, basic_auth=(USER, PASS))
+    jira_server = get_jira()
     issues = jira_server.search_issues(
         'updated >= -7d AND participants in (currentUser())')
     return issues
@@ -33,8 +81,7 @@ def parse_html(entry):
     Parse the html (within the atom feed) and return a list
     of the text nodes.
     """
-    parser = etree.HTMLParser()
-    tree = etree.parse(StringIO(entry), parser)
+    tree = etree.parse(StringIO(entry), HTML_PARSER)
     parsed = [x for x in tree.iter()]
     body = parsed[0]
     # get all the text nodes of the document:
@@ -42,54 +89,216 @@ def parse_html(entry):
     return text
 
 
+def to_millis(timestamp):
+    """
+    Convert an Atom timestamp to milliseconds since the epoch (what the
+    activity stream's date filters use)
+    """
+    match = UTC_TIMESTAMP_RE.match(timestamp)
+    if match:
+        fields = [int(x) for x in match.groups()[:6]]
+        millis = int((match.group(7) or '0').ljust(3, '0')[:3])
+        return calendar.timegm(fields) * 1000 + millis
+    parsed = dateutil.parser.parse(timestamp)
+    return calendar.timegm(parsed.utctimetuple()) * 1000 + \
+        parsed.microsecond // 1000
+
+
+def iter_activity(source):
+    """
+    Generate (updated, issue key) for each entry in an Atom feed (a
+    file-like object) in one pass over the feed. updated is in
+    milliseconds and the key is None unless the entry logs time.
+    """
+    updated = issue_key = None
+    for event, element in etree.iterparse(
+            source, events=('end',),
+            tag=(ATOM_TITLE, ATOM_UPDATED, ATOM_ENTRY)):
+        if element.tag == ATOM_ENTRY:
+            yield updated, issue_key
+            updated = issue_key = None
+            # we're done with the entry, so free it:
+            element.clear()
+            continue
+        # only the entry's own elements, not those of the objects in it:
+        if element.getparent().tag != ATOM_ENTRY:
+            continue
+        if element.tag == ATOM_UPDATED:
+            updated = to_millis(element.text.strip())
+            continue
+        title = element.text or ''
+        if 'logged' not in title:
+            continue
+        match = LOGGED_RE.search(title)
+        if match:
+            issue_key = match.group(1)
+        else:
+            # the markup isn't what was expected, so do it the slow way:
+            issue_key = re.search(r'^(\S+)', parse_html(title)[2]).group(1)
+
+
+def iter_logged_issues(source):
+    """
+    Generate the issue key of each entry in an Atom feed (a file-like
+    object) that logs time, in one pass over the feed.
+    """
+    for updated, issue_key in iter_activity(source):
+        if issue_key:
+            yield issue_key
+
+
 def get_logged_issues(atom_xml):
     """
     Return a list of issue keys that have time logged against them.
     """
-    # parse the atom feed
-    parsed = feedparser.parse(atom_xml)
-    # find the 'title' entries in there that have 'logged' in the
-    # text
+    return sorted(set(iter_logged_issues(BytesIO(atom_xml))))
 
-    entries = [x['title'] for
-               x in parsed['entries'] if 'logged' in x['title']]
 
-    issue_keys = list()
-    for entry in entries:
-        text = parse_html(entry)
-        issue_key = re.search(r'^(\S+)', text[2]).group(1)
-        issue_keys.append(issue_key)
-    return list(set(issue_keys))
+def get_session():
+    """
+    Return a requests session shared by the activity stream requests so
+    that the connection is kept alive between them.
+    """
+    global session
+    if session is None:
+        session = requests.Session()
+        session.auth = (USER, PASS)
+    return session
 
 
-def get_activity_stream():
+def get_activity_stream(after=None, before=None):
     """
-    Get the user's Atlassian Activity Stream.
+    Get the user's Atlassian Activity Stream, optionally only the entries
+    updated after and/or before the given times (in milliseconds).
     """
 
+    filters = ''
+    if after is not None:
+        filters += '&streams=update-date+AFTER+{}'.format(after)
+    if before is not None:
+        filters += '&streams=update-date+BEFORE+{}'.format(before)
     url = urlparse.urlunparse(
         ('https', '{}'.format(JIRA_HOST), '/activity', '',
          'maxResults={}&streams=user+IS+{}&os_authType=basic'
-         '&title=Activity'.format(NUM_ITEMS, USER),
+         '&title=Activity{}'.format(NUM_ITEMS, USER, filters),
          ''))
-    response = requests.get(url, auth=(USER, PASS))
+    response = get_session().get(url)
     return response.content
 
 
+def get_activity_slice(bounds):
+    """
+    Return the issue keys with time logged between two times (in
+    milliseconds), asking for one page of the activity stream after
+    another until the start is reached.
+    """
+    after, before = bounds
+    issue_keys = set()
+    while True:
+        content = get_activity_stream(after=after, before=before)
+        count = 0
+        oldest = before
+        for updated, issue_key in iter_activity(BytesIO(content)):
+            count += 1
+            if updated is not None:
+                oldest = min(oldest, updated)
+            if issue_key:
+                issue_keys.add(issue_key)
+        # a short page is the last one; also stop if the page didn't get
+        # any older (so as not to ask for the same page forever):
+        if count < int(NUM_ITEMS) or oldest <= after or oldest >= before - 1:
+            return issue_keys
+        # BEFORE is exclusive, so ask again from the oldest millisecond to
+        # pick up any of its entries that didn't fit on this page (the keys
+        # seen twice are collapsed by the set):
+        before = oldest + 1
+
+
+def get_recent_logged_issues(days=7):
+    """
+    Return a list of issue keys that have had time logged against them in
+    the last few days. The window is split into one slice per day and the
+    slices are fetched (and parsed) concurrently.
+    """
+    now = int(time.time() * 1000)
+    day = 24 * 60 * 60 * 1000
+    # AFTER and BEFORE are both exclusive, so each slice runs on a
+    # millisecond into the next one to take in the boundary between them:
+    slices = [(now - (x + 1) * day, now - x * day + 1) for x in range(days)]
+    if len(slices) < 2:
+        return sorted(set().union(*[get_activity_slice(x) for x in slices]))
+    issue_keys = set()
+    pool = ThreadPool(min(WORKERS, len(slices)))
+    try:
+        # take each slice's keys as soon as it's done:
+        for keys in pool.imap_unordered(get_activity_slice, slices):
+            issue_keys.update(keys)
+    finally:
+        pool.close()
+        pool.join()
+    return sorted(issue_keys)
+
+
+def pool_map(func, items):
+    '''
+    map() over a small pool of threads (they're all waiting on JIRA)
+    '''
+    if len(items) < 2:
+        return [func(x) for x in items]
+    pool = ThreadPool(min(WORKERS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def search_issues(issues):
+    '''
+    Return a dictionary of issue key to issue, with the description and
+    the first page of worklogs, using one search per BATCH_SIZE keys
+    '''
+    jira_server = get_jira()
+    found = dict()
+    for start in range(0, len(issues), BATCH_SIZE):
+        batch = issues[start:start + BATCH_SIZE]
+        # don't validate so that a key that's gone doesn't fail the batch:
+        results = jira_server.search_issues(
+            'key in ({})'.format(','.join(batch)), maxResults=len(batch),
+            validate_query=False, fields='description,worklog')
+        for issue in results:
+            found[issue.key] = issue
+    # an issue that's been moved comes back under its new key, so look
+    # anything that's missing up on its own:
+    missing = [x for x in issues if x not in found]
+    fetched = pool_map(
+        lambda x: jira_server.issue(x, fields='description,worklog'), missing)
+    found.update(zip(missing, fetched))
+    return found
+
+
 def get_worklogs(issues):
     """
     Get JIRA worklog entries for a list of issues.
     """
 
-    jira_options = {'server': 'https://{}'.format(JIRA_HOST)}
-    jira_server = JIRA(jira_options, basic_auth=(USER, PASS))
+    jira_server = get_jira()
+    issues = list(issues)
+    found = search_issues(issues)
+
+    # a search only includes the first page of worklogs (20 of them):
+    incomplete = [x for x in issues
+                  if found[x].fields.worklog.total >
+                  len(found[x].fields.worklog.worklogs)]
+    worklogs = dict(zip(incomplete, pool_map(
+        lambda x: jira_server.worklogs(issue=x), incomplete)))
 
     entries = list()
 
     for issue_key in issues:
-        description = jira_server.issue(issue_key).fields.description
-        worklogs = jira_server.worklogs(issue=issue_key)
-        for worklog in worklogs:
+        description = found[issue_key].fields.description
+        for worklog in worklogs.get(issue_key,
+                                    found[issue_key].fields.worklog.worklogs):
             entry = dict()
             entry['issue_key'] = issue_key
             entry['issue_description'] = description
@@ -101,8 +310,116 @@ def get_worklogs(issues):
     return entries
 
 
+def rest_url(path):
+    return 'https://{}/rest/api/2/{}'.format(JIRA_HOST, path)
+
+
+def get_updated_worklog_ids(since):
+    """
+    Return the ids of the worklogs created or updated since a time (in
+    milliseconds since the epoch) and the time to start from next time.
+    """
+    session = get_jira()._session
+    ids = list()
+    while True:
+        response = session.get(rest_url('worklog/updated'),
+                               params={'since': since})
+        response.raise_for_status()
+        page = response.json()
+        ids.extend(x['worklogId'] for x in page['values'])
+        since = page['until']
+        if page['lastPage']:
+            return ids, since
+
+
+def get_worklogs_by_id(ids):
+    session = get_jira()._session
+    worklogs = list()
+    for start in range(0, len(ids), WORKLOG_BATCH_SIZE):
+        response = session.post(
+            rest_url('worklog/list'),
+            data=json.dumps({'ids': ids[start:start + WORKLOG_BATCH_SIZE]}),
+            headers={'Content-Type': 'application/json'})
+        response.raise_for_status()
+        worklogs.extend(response.json())
+    return worklogs
+
+
+def is_mine(worklog):
+    author = worklog.get('author', dict())
+    return USER in (author.get('name'), author.get('key'),
+                    author.get('emailAddress'))
+
+
+def get_issue_details(issue_ids, cache):
+    """
+    Return a dictionary of issue id to (key, description). Descriptions are
+    kept in cache (by issue id) along with the issue's 'updated' time and
+    only fetched again once the issue has been updated.
+    """
+    jira_server = get_jira()
+    issue_ids = sorted(issue_ids)
+    stale = list()
+    for start in range(0, len(issue_ids), BATCH_SIZE):
+        batch = issue_ids[start:start + BATCH_SIZE]
+        for issue in jira_server.search_issues(
+                'id in ({})'.format(','.join(batch)), maxResults=len(batch),
+                validate_query=False, fields='updated'):
+            cached = cache.get(issue.id)
+            if not cached or cached['updated'] != issue.fields.updated:
+                stale.append(issue.id)
+    for start in range(0, len(stale), BATCH_SIZE):
+        batch = stale[start:start + BATCH_SIZE]
+        for issue in jira_server.search_issues(
+                'id in ({})'.format(','.join(batch)), maxResults=len(batch),
+                validate_query=False, fields='updated,description'):
+            cache[issue.id] = {'key': issue.key,
+                               'updated': issue.fields.updated,
+                               'description': issue.fields.description}
+    return dict((x, (cache[x]['key'], cache[x]['description']))
+                for x in issue_ids if x in cache)
+
+
+def sync_worklogs(state):
+    """
+    Get the configured user's JIRA worklog entries that have been created or
+    updated since the last sync, which is recorded in state.
+    """
+    since = state.get('cursor')
+    if since is None:
+        since = int((time.time() - DAYS * 24 * 60 * 60) * 1000)
+    ids, until = get_updated_worklog_ids(since)
+    worklogs = [x for x in get_worklogs_by_id(ids) if is_mine(x)]
+    issues = get_issue_details(set(x['issueId'] for x in worklogs),
+                               state.setdefault('issues', dict()))
+
+    entries = list()
+    for worklog in worklogs:
+        if worklog['issueId'] not in issues:
+            continue
+        issue_key, description = issues[worklog['issueId']]
+        entry = dict()
+        entry['issue_key'] = issue_key
+        entry['issue_description'] = description
+        entry['timeSpentSeconds'] = worklog['timeSpentSeconds']
+        entry['created'] = worklog['created']
+        entry['comment'] = worklog.get('comment')
+        entry['source'] = 'JIRA'
+        entries.append(entry)
+
+    # only move the cursor on once everything has been read:
+    state['cursor'] = until
+    return entries
+
+
 if __name__ == '__main__':
-    xml_data = get_activity_stream()
-    issues = get_logged_issues(xml_data)
-    entries = get_worklogs(issues)
+    if 'app_dir' in config:
+        filename = '{}/jira-state.shelve'.format(
+            expanduser(config['app_dir']))
+        state = shelve.open(filename, flag='c', writeback=True)
+        entries = sync_worklogs(state)
+        state.close()
+    else:
+        issues = get_recent_logged_issues(DAYS)
+        entries = get_worklogs(issues)
     print json.dumps(entries, indent=2)
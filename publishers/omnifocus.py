@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
+import functools
 import itertools
 import json
 import logging
 import logging.handlers
 import os
+import anydbm
 import re
 import shelve
+import sqlite3
 import zipfile
 from datetime import datetime, timedelta
+from multiprocessing import Pool
 from os.path import expanduser
 from StringIO import StringIO
 
@@ -21,9 +25,31 @@ utc = pytz.timezone('UTC')
 days_ago = timedelta(days=10)
 ns = {'of': 'http://www.omnigroup.com/namespace/OmniFocus/v1'}
 
-xpath_find = etree.XPath("//*[@id = $name]", namespaces=ns)
-
-ids = dict()
+NAME = '{{{}}}name'.format(ns['of'])
+CONTEXT = '{{{}}}context'.format(ns['of'])
+COMPLETED = '{{{}}}completed'.format(ns['of'])
+ESTIMATED_MINUTES = '{{{}}}estimated-minutes'.format(ns['of'])
+# completion dates are written like 2013-05-13T18:25:45.642Z, which sort
+# as strings the same as they do as dates:
+ISO_DATE_RE = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$')
+# transactions are named after the time they were made, e.g.
+# 20130513182545=jC6tYVQXXGk+hE8P0Z5lQmX.zip (the first one is all zeros):
+TRANSACTION_RE = re.compile(r'^(\d{14})=')
+# the parts of a task task_fields looks at, by fully qualified tag:
+TASK_FIELDS = {NAME: 'name', COMPLETED: 'completed',
+               ESTIMATED_MINUTES: 'estimated'}
+
+find_parent_context = etree.XPath('../of:context', namespaces=ns)
+find_parent_project = etree.XPath('../of:task|../of:project|../of:folder',
+                                  namespaces=ns)
+find_context = etree.XPath('of:context', namespaces=ns)
+find_project = etree.XPath('of:project|of:task|of:folder', namespaces=ns)
+find_name = etree.XPath('of:name', namespaces=ns)
+find_estimated_minutes = etree.XPath(
+    'following-sibling::of:estimated-minutes', namespaces=ns)
+
+PROJECT_TAGS = tuple('{{{}}}{}'.format(ns['of'], x)
+                     for x in ('project', 'task', 'folder'))
 
 config = ConfigObj(expanduser('~/.m6rc'))
 log_file = '{}/m6.log'.format(expanduser(config['main']['log_dir']))
@@ -35,40 +61,41 @@ handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=500000,
 logger.addHandler(handler)
 
 
-def follow_idref(element):
+def index_ids(element):
+    '''
+    Map the ids in element's document to the elements that have them
+    '''
+    root = element.getroottree().getroot()
+    return {x.get('id'): x for x in root.iterfind('.//*[@id]')}
+
+
+def follow_idref(element, index=None):
     '''
     Given an element with an 'idref' attribute, return the
     element it references
     '''
     if 'idref' in element.keys():
-        idref = element.get('idref')
-        # cache results because xpath is slow:
-        if idref in ids:
-            return ids[idref]
-
-        #xpath = '//*[@id="{}"]'.format(element.get('idref'))
-        #node = xpath_evaluator('//*[@id="{}"]'.format(
-        # element.get('idref')))[0]
-        node = xpath_find(element, name=element.get('idref'))[0]
-        #node = element.xpath(xpath, namespaces=ns)[0]
-        ids[idref] = node
-        return node
+        if index is None:
+            index = index_ids(element)
+        return index[element.get('idref')]
     return element
 
 
-def get_context(element):
+def get_context(element, index=None):
     '''
     Given an element traverse the tree recursively to find
     its context if there is one
     '''
     if not element.tag.endswith('context'):
-        context = element.xpath('../of:context', namespaces=ns)
+        context = find_parent_context(element)
         if not context:
             return [None]
         element = context[0]
-    element = follow_idref(element)
-    child = element.xpath('of:context', namespaces=ns)
-    name = element.xpath('of:name', namespaces=ns)
+    if index is None:
+        index = index_ids(element)
+    element = follow_idref(element, index)
+    child = find_context(element)
+    name = find_name(element)
     if name:
         name = name[0].text.strip()
     else:
@@ -78,20 +105,21 @@ def get_context(element):
     if not child:
         return [name]
     # if it does, recurse:
-    return get_context(child[0]) + [name]
+    return get_context(child[0], index) + [name]
 
 
-def get_project(element):
+def get_project(element, index=None):
 
     if not element.tag.endswith(('task', 'project', 'folder')):
-        task = element.xpath(
-            '../of:task|../of:project|../of:folder', namespaces=ns)
+        task = find_parent_project(element)
         if not task:
             return [None]
         element = task[0]
-    element = follow_idref(element)
-    child = element.xpath('of:project|of:task|of:folder', namespaces=ns)
-    name = element.xpath('of:name', namespaces=ns)
+    if index is None:
+        index = index_ids(element)
+    element = follow_idref(element, index)
+    child = find_project(element)
+    name = find_name(element)
     if name:
         name = name[0].text.strip()
     else:
@@ -101,7 +129,167 @@ def get_project(element):
     if not child:
         return [name]
     # if it does, recurse:
-    return get_project(child[0]) + [name]
+    return get_project(child[0], index) + [name]
+
+
+class Hierarchy(object):
+    '''
+    A table of the names of a document's contexts, projects, folders and
+    tasks along with the keys of their parent context and project, so that
+    paths are dictionary lookups rather than walks up the tree (and can be
+    worked out after the elements are gone)
+    '''
+
+    def __init__(self, element=None):
+        self.table = dict()
+        self.contexts = dict()
+        self.projects = dict()
+        if element is not None:
+            root = element.getroottree().getroot()
+            for node in root.iterfind('.//*[@id]'):
+                self.record(node, node.get('id'))
+
+    def key(self, element):
+        '''
+        The key element is recorded under (recording it if it isn't yet);
+        elements without an id get one made up from their parent's
+        '''
+        key = element.get('id')
+        if key is None:
+            parent = element.getparent()
+            key = '{}/{}'.format(parent.get('id') if parent is not None
+                                 else None, etree.QName(element).localname)
+        if key not in self.table:
+            self.record(element, key)
+        return key
+
+    def child_key(self, element, parent_key):
+        # a reference to an element elsewhere, or one defined inline:
+        if 'idref' in element.keys():
+            return element.get('idref')
+        key = '{}/{}'.format(parent_key, etree.QName(element).localname)
+        self.record(element, key)
+        return key
+
+    def record(self, element, key):
+        name = context = project = None
+        for child in element.iterchildren():
+            if child.tag == NAME and name is None:
+                name = (child.text or '').strip()
+            elif child.tag == CONTEXT and context is None:
+                context = self.child_key(child, key)
+            elif child.tag in PROJECT_TAGS and project is None:
+                project = self.child_key(child, key)
+        self.table[key] = (name, context, project)
+
+    def name(self, key):
+        return self.table[key][0]
+
+    def context(self, key):
+        '''
+        The names of the context of key and its parents, outermost first,
+        as get_context gives them
+        '''
+        return list(self.path(self.table[key][1], 1, self.contexts))
+
+    def project(self, key):
+        '''
+        The names of the project of key and its parents, outermost first,
+        as get_project gives them
+        '''
+        return list(self.path(self.table[key][2], 2, self.projects))
+
+    def path(self, key, field, memo):
+        if key in memo:
+            return memo[key]
+        if key not in self.table:
+            return (None,)
+        parent = self.table[key][field]
+        if parent is None:
+            path = (self.table[key][0],)
+        else:
+            path = self.path(parent, field, memo) + (self.table[key][0],)
+        memo[key] = path
+        return path
+
+
+class TaskStore(object):
+    '''
+    What's known about each task (its name, context and project) by id,
+    kept in SQLite so that looking one up doesn't mean loading all of them;
+    writes are saved up and made in batches
+    '''
+
+    def __init__(self, filename, batch_size=500):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, '
+            'name TEXT, context TEXT, project TEXT)')
+        self.batch_size = batch_size
+        self.pending = dict()
+
+    def get(self, identity, default=None):
+        if identity in self.pending:
+            return self.pending[identity]
+        row = self.connection.execute(
+            'SELECT name, context, project FROM tasks WHERE id = ?',
+            (identity,)).fetchone()
+        if row is None:
+            return default
+        return (row[0], json.loads(row[1]), json.loads(row[2]))
+
+    def __contains__(self, identity):
+        return self.get(identity) is not None
+
+    def __getitem__(self, identity):
+        value = self.get(identity)
+        if value is None:
+            raise KeyError(identity)
+        return value
+
+    def __setitem__(self, identity, value):
+        self.pending[identity] = tuple(value)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM tasks').fetchone()[0]
+
+    def update(self, other):
+        for identity in other:
+            self[identity] = other[identity]
+
+    def flush(self):
+        if not self.pending:
+            return
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?)',
+                [(x, y[0], json.dumps(y[1]), json.dumps(y[2]))
+                 for x, y in self.pending.items()])
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+def task_fields(element):
+    '''
+    The parts of a task (see TASK_FIELDS) in one pass over its children;
+    the estimate only counts if it comes after the completion date
+    '''
+    fields = dict()
+    for child in element.iterchildren():
+        field = TASK_FIELDS.get(child.tag)
+        if field is None:
+            continue
+        if field == 'estimated' and 'completed' not in fields:
+            continue
+        fields[field] = child.text.strip()
+    return fields
 
 
 def mk_dict(**kwargs):
@@ -114,112 +302,391 @@ def mk_dict(**kwargs):
 
 class OmniFocus (object):
 
-    def __init__(self, config=None, id_map=None):
+    def __init__(self, config=None, id_map=None, manifest=None, cache=None):
         self.config = config
         self.id_map = id_map
+        # what's been read from each transaction file so far:
+        self.manifest = manifest
+        # what's been read from each zip member, by its CRC and size (the
+        # same member can turn up in more than one transaction file):
+        self.cache = cache
+        # keep tasks completed before the window when reading (they're
+        # still left out when the changes are applied):
+        self.all_dates = False
 
     def get_estimated_minutes(self, element):
-        foo = element.xpath(
-            'following-sibling::of:estimated-minutes',
-            namespaces=ns)
+        foo = find_estimated_minutes(element)
         if foo:
             return foo[0].text.strip()
         return self.config['default_duration']
 
-    def process_task(self, element, identity):
-        out = None
-        for child in element.iterchildren():
-#            if re.match('.*project$', child.tag):
-#                return
-            if re.match('.*name$', child.tag):
-                name = child.text.strip()
-                context = [x for x in get_context(child) if x]
-                project = [x for x in get_project(child) if x]
-                self.id_map[identity] = (name, context, project)
-            elif re.match('.*completed$', child.tag):
-                completed = child.text.strip()
-                context = get_context(child)
-                estimated_minutes = self.get_estimated_minutes(child).strip()
-                out = mk_dict(
-                    project=project, context=context, task=name,
-                    dateCompleted=completed,
-                    estimatedMinutes=estimated_minutes,
-                    disposition="completed")
-                logger.info(
-                    "{} completed on {} in {} as part of project {}".format(
-                        name.encode('utf-8'), completed, context, project))
-            elif re.match('.*estimated-minutes$', child.tag):
-                completed = child.text
+    def process_task(self, element, identity, hierarchy=None):
+        saved, out = self.read_task(element, hierarchy)
+        if saved:
+            self.id_map[identity] = saved
         return out
 
+    def read_task(self, element, hierarchy=None):
+        '''
+        Return what should be remembered about a task for when it's deleted
+        and the entry for it if it was completed
+        '''
+        if hierarchy is None:
+            hierarchy = Hierarchy(element)
+        return self.task_entry(task_fields(element), hierarchy.key(element),
+                               hierarchy)
+
+    def task_entry(self, fields, key, hierarchy):
+        '''
+        Turn the fields task_fields found into what read_task returns, with
+        the task's context and project looked up in hierarchy
+        '''
+        if 'name' not in fields:
+            return None, None
+        name = fields['name']
+        context = hierarchy.context(key)
+        project = [x for x in hierarchy.project(key) if x]
+        saved = (name, [x for x in context if x], project)
+        if 'completed' not in fields:
+            return saved, None
+
+        completed = fields['completed']
+        estimated_minutes = fields.get(
+            'estimated', self.config['default_duration']).strip()
+        out = mk_dict(
+            project=project, context=context, task=name,
+            dateCompleted=completed,
+            estimatedMinutes=estimated_minutes,
+            disposition="completed")
+        logger.info(
+            "{} completed on {} in {} as part of project {}".format(
+                name.encode('utf-8'), completed, context, project))
+        return saved, out
+
+    def window_start(self):
+        if getattr(self, 'start', None) is None:
+            self.start = datetime.now().replace(tzinfo=utc) - timedelta(
+                days=int(self.config['days_ago']))
+            # (not strftime, which can't do years before 1900):
+            self.start_text = self.start.isoformat()[:19]
+        return self.start
+
+    def too_old(self, completed):
+        start = self.window_start()
+        completed = completed.strip()
+        # compare the text when it's precise enough to tell, which saves
+        # parsing nearly every date:
+        if ISO_DATE_RE.match(completed) and \
+                completed[:19] != self.start_text:
+            return completed[:19] < self.start_text
+        return parser.parse(completed) < start
+
+    def in_window(self, name):
+        '''
+        Whether a transaction file could have anything completed in the
+        window in it (nothing in it can be newer than the file)
+        '''
+        match = TRANSACTION_RE.match(name)
+        if not match or match.group(1) == '0' * 14:
+            return True
+        # a day's grace for the difference between local time and UTC:
+        start = self.window_start() - timedelta(days=1)
+        return match.group(1) >= re.sub(r'\D', '', start.isoformat()[:19])
+
     def get_saved_of_ids(self, identity):
-        if identity in self.id_map:
-            return self.id_map[identity]
-        return [None, None, None]
+        return self.id_map.get(identity, [None, None, None])
+
+    def apply(self, changes):
+        '''
+        Play changes (as read_xml and read_stream give them) against
+        id_map in order and return the entries they produce
+        '''
+        results = list()
+        for operation, identity, completed, saved, output in changes:
+            if self.too_old(completed):
+                continue
+            if operation == 'delete':
+                name, context, project = self.get_saved_of_ids(identity)
+                if not name:
+                    continue
+                output = mk_dict(project=project, context=context, task=name,
+                                 disposition="deleted")
+            elif saved:
+                self.id_map[identity] = saved
+            if output:
+                results.append(output)
+        return results
 
     def process_xml(self, xml):
+        return self.apply(self.read_xml(xml))
 
-        results = list()
+    def read_xml(self, xml):
+        return self.read_tree(StringIO(xml))
+
+    def read_tree(self, source):
+        '''
+        Return the changes in a transaction: for each completed task what
+        to remember about it and its entry, or that it was deleted
+        '''
+        changes = list()
 #        context = etree.iterparse(
 #            StringIO(xml), # tag='{{{}}}task'.format(ns['of']),
 #        )
-        tree = etree.parse(StringIO(xml))
+        tree = etree.parse(source)
         root = tree.getroot()
-        global xpath_evaluator
-        xpath_evaluator = etree.XPathEvaluator(root)
+        # only good for this document, so it goes when the tree does:
+        hierarchy = Hierarchy(root)
 
-        for element in root.findall('.//of:completed', namespaces=ns):
-            delta = datetime.now().replace(tzinfo=utc) - parser.parse(
-                element.text)
-            if delta > timedelta(days=int(self.config['days_ago'])):
+        for element in root.iter(COMPLETED):
+            if not self.all_dates and self.too_old(element.text):
                 continue
+            completed = element.text.strip()
             element = element.getparent()
             operation = element.get('op')
             identity = element.get('id')
             if operation == 'delete':
-                name, context, project = self.get_saved_of_ids(identity)
-                if not name:
-                    continue
-                output = mk_dict(project=project, context=context, task=name,
-                                 disposition="deleted")
-                results.append(output)
+                changes.append((operation, identity, completed, None, None))
             else:
-                output = self.process_task(element, identity)
-                if output:
-                    results.append(output)
-        return results
+                saved, output = self.read_task(element, hierarchy)
+                changes.append((operation, identity, completed, saved,
+                                output))
+        return changes
+
+    def process_stream(self, source):
+        return self.apply(self.read_stream(source))
+
+    def read_stream(self, source):
+        '''
+        Like read_xml, but parse source (a file name or file object) as
+        it's read, throwing away each top level element once it's been
+        looked at, so memory doesn't grow with the size of the document
+        '''
+        hierarchy = Hierarchy()
+        pending = list()
+        depth = 0
+        for event, element in etree.iterparse(source,
+                                              events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if depth != 1:
+                continue
+
+            if element.get('id'):
+                hierarchy.record(element, element.get('id'))
+            for completed in element.iter(COMPLETED):
+                if not self.all_dates and self.too_old(completed.text):
+                    continue
+                task = completed.getparent()
+                pending.append((task.get('op'), task.get('id'),
+                                hierarchy.key(task), task_fields(task)))
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+        # contexts and projects can be defined after the tasks that refer
+        # to them, so tasks are only resolved once the whole document has
+        # been read:
+        changes = list()
+        for operation, identity, key, fields in pending:
+            if operation == 'delete':
+                changes.append(
+                    (operation, identity, fields['completed'], None, None))
+                continue
+            saved, output = self.task_entry(fields, key, hierarchy)
+            changes.append(
+                (operation, identity, fields['completed'], saved, output))
+        return changes
 
     def process_xml_file(self, zip_file, file):
-        data = zip_file.read(file)
-        out = self.process_xml(data)
-        return out
+        return self.apply(self.read_xml_file(zip_file, file))
+
+    def read_xml_file(self, zip_file, file):
+        # the parser reads straight from the zip member:
+        member = zip_file.open(file)
+        try:
+            if 'stream' in self.config and \
+                    not self.config.as_bool('stream'):
+                return self.read_tree(member)
+            return self.read_stream(member)
+        finally:
+            member.close()
+
+    def read_zip(self, path, cached=()):
+        '''
+        Return the key and changes of each member of a transaction file;
+        members with keys in cached aren't read and have None for changes
+        '''
+        logger.debug('processing file {}'.format(path))
+        members = list()
+        zip_file = zipfile.ZipFile(path, 'r')
+        for info in zip_file.infolist():
+            key = member_key(info)
+            if key in cached:
+                members.append((key, None))
+                continue
+            logger.debug('processing XML file {}'.format(info.filename))
+            members.append((key, self.read_xml_file(zip_file, info)))
+        zip_file.close()
+        return members
+
+    def unchanged(self, path, name):
+        '''
+        Whether a transaction file is the one its manifest entry was made
+        from; when only the time stamp has changed the entry is updated
+        '''
+        entry = self.manifest[name]
+        stat = os.stat(path)
+        if (stat.st_size, stat.st_mtime) == (entry['size'], entry['mtime']):
+            return True
+        if stat.st_size != entry['size'] or crcs(path) != entry['crcs']:
+            return False
+        entry['mtime'] = stat.st_mtime
+        # (the manifest is a shelve, so the entry has to be stored again):
+        self.manifest[name] = entry
+        return True
+
+    def read_zips(self, paths):
+
+        cached = [()] * len(paths)
+        if self.cache is not None:
+            # members seen in an earlier file will be in the cache by the
+            # time the changes are put together below:
+            seen = set()
+            cached = list()
+            for path in paths:
+                keys = member_keys(path)
+                cached.append([x for x in keys
+                               if x in seen or x in self.cache])
+                seen.update(keys)
+
+        # reading doesn't touch id_map, so files can be read in other
+        # processes and their changes applied here in order:
+        workers = int(self.config.get('workers', 1))
+        if workers > 1 and len(paths) > 1:
+            pool = Pool(min(workers, len(paths)))
+            try:
+                files = pool.map(functools.partial(
+                    read_zip, self.config, all_dates=self.all_dates),
+                    zip(paths, cached))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            files = [self.read_zip(x, y) for x, y in zip(paths, cached)]
+
+        changes = list()
+        for members in files:
+            file_changes = list()
+            for key, member_changes in members:
+                if member_changes is None:
+                    member_changes = self.cache[key]
+                elif self.cache is not None:
+                    self.cache[key] = member_changes
+                file_changes.extend(member_changes)
+            changes.append(file_changes)
+        return changes
 
     def go(self, directory):
 
-        results = list()
-
-        for file in os.listdir(directory):
-#            if re.match('^0000', file):
-#               continue
-            logger.debug('processing file {}'.format(file))
-            zip_file = zipfile.ZipFile(directory + "/" + file, 'r')
-            for name in zip_file.namelist():
-                logger.debug('processing XML file {}'.format(name))
-                out = self.process_xml_file(zip_file, name)
-                results.append(out)
-        # flatten list:
-        return list(itertools.chain.from_iterable(results))
+        # transactions are named so that they sort in the order they
+        # were made in:
+        names = sorted(os.listdir(directory))
+        # forget files that have gone away:
+        if self.manifest is not None:
+            for name in set(self.manifest) - set(names):
+                del self.manifest[name]
+        # files from before the window aren't even opened:
+        names = [x for x in names if self.in_window(x)]
+        paths = [os.path.join(directory, x) for x in names]
+
+        # what's kept between runs is read whatever the window (which
+        # will have moved by the time it's replayed):
+        self.all_dates = self.manifest is not None or self.cache is not None
+        try:
+            if self.manifest is None:
+                changes = self.read_zips(paths)
+                return self.apply(itertools.chain.from_iterable(changes))
+
+            # transaction files don't change once they're written, so only
+            # new ones need reading; the changes of the rest are replayed:
+            new = [x for x, y in zip(paths, names) if y not in self.manifest
+                   or not self.unchanged(x, y)]
+            for path, changes in zip(new, self.read_zips(new)):
+                stat = os.stat(path)
+                self.manifest[os.path.basename(path)] = {
+                    'size': stat.st_size, 'mtime': stat.st_mtime,
+                    'crcs': crcs(path), 'changes': changes,
+                    'latest': max([x[2] for x in changes] or [None])}
+        finally:
+            self.all_dates = False
+
+        # files with nothing completed in the window aren't replayed:
+        entries = [self.manifest[x] for x in names]
+        return self.apply(itertools.chain.from_iterable(
+            x['changes'] for x in entries
+            if x.get('latest') is None or not self.too_old(x['latest'])))
+
+
+def crcs(path):
+    zip_file = zipfile.ZipFile(path, 'r')
+    members = [(x.filename, x.CRC) for x in zip_file.infolist()]
+    zip_file.close()
+    return members
+
+
+def member_key(info):
+    return '{}:{}'.format(info.CRC, info.file_size)
+
+
+def member_keys(path):
+    zip_file = zipfile.ZipFile(path, 'r')
+    keys = [member_key(x) for x in zip_file.infolist()]
+    zip_file.close()
+    return keys
+
+
+def read_zip(config, work, all_dates=False):
+    # a function at the top level so that it can be handed to a Pool:
+    path, cached = work
+    reader = OmniFocus(config)
+    reader.all_dates = all_dates
+    return reader.read_zip(path, cached)
 
 
 if __name__ == '__main__':
 
     config = config['omnifocus']
     directory = os.path.expanduser(config['zip_dir'])
-    filename = '{}/omnifocus-ids.shelve'.format(expanduser(config['app_dir']))
-    saved_of_ids = shelve.open(filename, flag='c', writeback=True)
-    omnifocuser = OmniFocus(config, saved_of_ids)
+    filename = '{}/omnifocus-tasks.sqlite'.format(
+        expanduser(config['app_dir']))
+    saved_of_ids = TaskStore(filename)
+    if not len(saved_of_ids):
+        # bring over what was kept in the shelve this replaces:
+        try:
+            old = shelve.open('{}/omnifocus-ids.shelve'.format(
+                expanduser(config['app_dir'])), flag='r')
+        except anydbm.error:
+            pass
+        else:
+            saved_of_ids.update(old)
+            old.close()
+    filename = '{}/omnifocus-manifest.shelve'.format(
+        expanduser(config['app_dir']))
+    manifest = shelve.open(filename, flag='c')
+    cache = None
+    if 'cache' in config and config.as_bool('cache'):
+        filename = '{}/omnifocus-members.shelve'.format(
+            expanduser(config['app_dir']))
+        cache = shelve.open(filename, flag='c')
+    omnifocuser = OmniFocus(config, saved_of_ids, manifest, cache)
 
     result = [x for x in omnifocuser.go(directory) if x]
+    if cache is not None:
+        cache.close()
+    manifest.close()
     saved_of_ids.close()
 
     print json.dumps(result, indent=2)
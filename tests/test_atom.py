@@ -1,9 +1,13 @@
 import unittest
+from io import BytesIO
+from publishers import jira_pub
 from publishers.jira_pub import parse_html
 from publishers.jira_pub import get_worklogs
 from publishers.jira_pub import get_logged_issues
 from publishers.jira_pub import get_activity_stream
 import feedparser
+import json
+import time
 
 
 class TestParseActivityStream(unittest.TestCase):
@@ -29,6 +33,12 @@ class TestParseActivityStream(unittest.TestCase):
         expected = ['FOOBAR-882', 'MMSANDBOX-2803']
         self.assertEqual(expected, actual)
 
+    def test_iter_activity(self):
+        actual = list(jira_pub.iter_activity(open('test_data/atom.xml')))
+        self.assertEqual(50, len(actual))
+        # 2013-05-14T19:49:58.629Z:
+        self.assertEqual((1368560998629, 'MMSANDBOX-2803'), actual[0])
+
     def test_get_activity_stream(self):
         # make sure the activity stream parses
         xml = get_activity_stream()
@@ -60,3 +70,210 @@ class TestParseActivityStream(unittest.TestCase):
                      'issue_key': 'MMSANDBOX-2803',
                      'timeSpentSeconds': 900}]
         self.assertEqual(expected, actual)
+
+
+class Resource(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeResponse(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.data
+
+
+class FakeSession(object):
+
+    def __init__(self, pages, worklogs):
+        self.pages = pages
+        self.worklogs = worklogs
+        self.calls = list()
+
+    def get(self, url, params):
+        self.calls.append(('get', params['since']))
+        return FakeResponse(self.pages[params['since']])
+
+    def post(self, url, data, headers):
+        ids = json.loads(data)['ids']
+        self.calls.append(('post', ids))
+        return FakeResponse([x for x in self.worklogs if x['id'] in ids])
+
+
+class FakeJIRA(object):
+
+    def __init__(self, issues, session=None):
+        self.issues = issues
+        self.calls = list()
+        self._session = session
+
+    def search_issues(self, jql, **kwargs):
+        self.calls.append(('search_issues', jql))
+        if jql.startswith('id in'):
+            return [x for x in self.issues.values() if x.id in jql]
+        return [x for x in self.issues.values() if x.key in jql]
+
+    def issue(self, key, **kwargs):
+        self.calls.append(('issue', key))
+        return self.issues['MOVED-1']
+
+    def worklogs(self, issue):
+        self.calls.append(('worklogs', issue))
+        return [Resource(timeSpentSeconds=60 * x, created='today',
+                         comment=str(x)) for x in range(25)]
+
+
+class TestBulkWorklogs(unittest.TestCase):
+
+    def setUp(self):
+        def issue(key, count, total=None):
+            worklogs = [Resource(timeSpentSeconds=60, created='today',
+                                 comment=str(x)) for x in range(count)]
+            worklog = Resource(total=total or count, worklogs=worklogs)
+            return Resource(key=key, fields=Resource(
+                description=key.lower(), worklog=worklog))
+        self.fake = FakeJIRA({'ABC-1': issue('ABC-1', 2),
+                              'ABC-2': issue('ABC-2', 20, total=25),
+                              'MOVED-1': issue('MOVED-1', 1)})
+        self.saved = jira_pub.jira_server
+        jira_pub.jira_server = self.fake
+
+    def tearDown(self):
+        jira_pub.jira_server = self.saved
+
+    def test_get_worklogs(self):
+        actual = get_worklogs(['ABC-1', 'ABC-2', 'OLD-1'])
+        self.assertEqual(2 + 25 + 1, len(actual))
+        self.assertEqual(['ABC-1', 'ABC-1'],
+                         [x['issue_key'] for x in actual[:2]])
+        self.assertEqual('abc-1', actual[0]['issue_description'])
+        self.assertEqual('OLD-1', actual[-1]['issue_key'])
+        self.assertEqual('moved-1', actual[-1]['issue_description'])
+        self.assertEqual([('search_issues', 'key in (ABC-1,ABC-2,OLD-1)'),
+                          ('issue', 'OLD-1'), ('worklogs', 'ABC-2')],
+                         self.fake.calls)
+
+
+class TestSyncWorklogs(unittest.TestCase):
+
+    def setUp(self):
+        def worklog(id, issue, user):
+            return {'id': id, 'issueId': issue, 'author': {'name': user},
+                    'timeSpentSeconds': 60, 'created': 'today',
+                    'comment': 'worklog {}'.format(id)}
+        pages = {100: {'values': [{'worklogId': 1}, {'worklogId': 2}],
+                       'until': 200, 'lastPage': False},
+                 200: {'values': [{'worklogId': 3}],
+                       'until': 300, 'lastPage': True},
+                 300: {'values': [], 'until': 300, 'lastPage': True}}
+        self.session = FakeSession(pages, [
+            worklog(1, '10', jira_pub.USER), worklog(2, '10', 'someone'),
+            worklog(3, '11', jira_pub.USER)])
+        issues = dict()
+        for id, key in (('10', 'ABC-1'), ('11', 'ABC-2')):
+            issues[key] = Resource(id=id, key=key, fields=Resource(
+                updated='yesterday', description=key.lower()))
+        self.fake = FakeJIRA(issues, self.session)
+        self.saved = jira_pub.jira_server
+        jira_pub.jira_server = self.fake
+
+    def tearDown(self):
+        jira_pub.jira_server = self.saved
+
+    def test_sync_worklogs(self):
+        state = {'cursor': 100}
+        actual = jira_pub.sync_worklogs(state)
+        self.assertEqual(['worklog 1', 'worklog 3'],
+                         [x['comment'] for x in actual])
+        self.assertEqual(['ABC-1', 'ABC-2'],
+                         [x['issue_key'] for x in actual])
+        self.assertEqual('abc-2', actual[1]['issue_description'])
+        self.assertEqual(300, state['cursor'])
+        self.assertEqual(['10', '11'], sorted(state['issues']))
+
+        # nothing new, and the descriptions are still fresh:
+        del self.fake.calls[:]
+        self.assertEqual([], jira_pub.sync_worklogs(state))
+        self.assertEqual(('get', 300), self.session.calls[-1])
+        self.assertEqual([], self.fake.calls)
+
+    def test_first_sync(self):
+        # with no cursor yet the sync goes back as far as [jira] days:
+        calls = list()
+
+        def get_updated_worklog_ids(since):
+            calls.append(since)
+            return list(), 300
+        saved = (jira_pub.DAYS, jira_pub.get_updated_worklog_ids)
+        jira_pub.DAYS = 2
+        jira_pub.get_updated_worklog_ids = get_updated_worklog_ids
+        try:
+            earliest = int((time.time() - 2 * 24 * 60 * 60) * 1000)
+            jira_pub.sync_worklogs(dict())
+            latest = int((time.time() - 2 * 24 * 60 * 60) * 1000)
+        finally:
+            jira_pub.DAYS, jira_pub.get_updated_worklog_ids = saved
+        self.assertTrue(earliest <= calls[0] <= latest)
+
+    def test_description_cache(self):
+        cache = dict()
+        jira_pub.get_issue_details(['10'], cache)
+        del self.fake.calls[:]
+        jira_pub.get_issue_details(['10'], cache)
+        self.assertEqual(1, len(self.fake.calls))
+        self.fake.issues['ABC-1'].fields.updated = 'today'
+        self.fake.issues['ABC-1'].fields.description = 'new'
+        actual = jira_pub.get_issue_details(['10'], cache)
+        self.assertEqual({'10': ('ABC-1', 'new')}, actual)
+
+
+class TestPagedActivityStream(unittest.TestCase):
+
+    def setUp(self):
+        self.atom_xml = open('test_data/atom.xml', 'r').read()
+        self.calls = list()
+        self.saved = (jira_pub.get_activity_stream, jira_pub.NUM_ITEMS)
+        jira_pub.get_activity_stream = self.get_activity_stream
+
+    def tearDown(self):
+        jira_pub.get_activity_stream, jira_pub.NUM_ITEMS = self.saved
+
+    def get_activity_stream(self, after=None, before=None):
+        self.calls.append((after, before))
+        if before > 1368560998629:
+            return self.atom_xml
+        return '<feed xmlns="http://www.w3.org/2005/Atom"/>'
+
+    def test_short_page(self):
+        jira_pub.NUM_ITEMS = '100'
+        actual = jira_pub.get_activity_slice((0, 2000000000000))
+        self.assertEqual(set(['FOOBAR-882', 'MMSANDBOX-2803']), actual)
+        self.assertEqual([(0, 2000000000000)], self.calls)
+
+    def test_full_page(self):
+        # the feed has 50 entries, so it's a full page:
+        jira_pub.NUM_ITEMS = '50'
+        jira_pub.get_activity_slice((0, 2000000000000))
+        self.assertEqual(2, len(self.calls))
+        # the next page starts at (and includes) the oldest millisecond:
+        oldest = min(x[0] for x in jira_pub.iter_activity(
+            BytesIO(self.atom_xml)))
+        self.assertEqual(oldest + 1, self.calls[1][1])
+
+    def test_get_recent_logged_issues(self):
+        jira_pub.NUM_ITEMS = '100'
+        actual = jira_pub.get_recent_logged_issues(days=3)
+        self.assertEqual(['FOOBAR-882', 'MMSANDBOX-2803'], actual)
+        self.assertEqual(3, len(self.calls))
+        # neighbouring slices overlap so that nothing on the boundary
+        # between them is missed:
+        calls = sorted(self.calls)
+        self.assertEqual(calls[0][1] - 1, calls[1][0])
+        self.assertEqual(calls[1][1] - 1, calls[2][0])
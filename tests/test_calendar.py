@@ -2,6 +2,7 @@ import unittest
 import datetime
 from datetime import timedelta
 import json
+import urllib
 from publishers import google_calendar
 import pytz
 
@@ -146,6 +147,22 @@ class TestCalendar(unittest.TestCase):
             'first.last@example.com')
         self.assertEqual('bar', actual[0]['tag'])
 
+    def test_single_pass(self):
+        # the fused pipeline gives the same answer as the separate steps:
+        items = json.loads(self.input_json)['items']
+        expected = [google_calendar.transform_dates(x)
+                    for x in json.loads(self.input_json)['items']]
+        for step in (google_calendar.filter_no_end_date,
+                     google_calendar.filter_cancelled_events,
+                     google_calendar.filter_private_entries,
+                     google_calendar.filter_declined_entries):
+            expected = step(expected)
+        expected = google_calendar.transform_data(expected,
+                                                  'first.last@example.com')
+        actual = google_calendar.iter_process(items, 'first.last@example.com')
+        self.assertNotIsInstance(actual, list)
+        self.assertEqual(expected, list(actual))
+
     def test_get_date(self):
         item = {'start': {u'dateTime': u'2013-04-30T13:00:00-05:00'}}
         actual = google_calendar.get_date(item, 'start')
@@ -222,3 +239,164 @@ class TestCalendar(unittest.TestCase):
             u'id': u'u8p1i9fmdrt6bmdp281eitc7us'}
         actual = google_calendar.filter_declined_entries([input])
         self.assertEqual([], actual)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status):
+        self.status = status
+
+
+class FakeHttp(object):
+    '''
+    Hands out canned pages of events, recording the requests made
+    '''
+
+    def __init__(self, pages):
+        self.pages = list(pages)
+        self.urls = list()
+
+    def request(self, url, method):
+        self.urls.append(url)
+        status, content = self.pages.pop(0)
+        return FakeResponse(status), json.dumps(content)
+
+
+def event(id, days=0, **kwargs):
+    start = datetime.datetime.utcnow() - timedelta(days=days)
+    end = start + timedelta(hours=1)
+    event = {u'id': id, u'iCalUID': id + u'@google.com',
+             u'summary': id, u'status': u'confirmed',
+             u'start': {u'dateTime': start.strftime('%Y-%m-%dT%H:%M:%SZ')},
+             u'end': {u'dateTime': end.strftime('%Y-%m-%dT%H:%M:%SZ')}}
+    event.update(kwargs)
+    return event
+
+
+class TestSync(unittest.TestCase):
+
+    def test_full_then_incremental(self):
+        store = dict()
+        http = FakeHttp([
+            (200, {'items': [event(u'a'), event(u'b')],
+                   'nextPageToken': 'page2'}),
+            (200, {'items': [event(u'c')], 'nextSyncToken': 'tok1'})])
+        events = google_calendar.sync(http, 'first.last@example.com', store)
+        self.assertEqual(['a', 'b', 'c'], sorted(events))
+        self.assertEqual('tok1', store['sync_token'])
+        self.assertIn('pageToken=page2', http.urls[1])
+
+        # only the changes come back the second time:
+        http = FakeHttp([
+            (200, {'items': [event(u'b', status=u'cancelled'),
+                             event(u'd', summary=u'new')],
+                   'nextSyncToken': 'tok2'})])
+        events = google_calendar.sync(http, 'first.last@example.com', store)
+        self.assertIn('syncToken=tok1', http.urls[0])
+        self.assertIn('singleEvents=true', http.urls[0])
+        self.assertNotIn('timeMin', http.urls[0])
+        self.assertEqual(['a', 'c', 'd'], sorted(events))
+        self.assertEqual('tok2', store['sync_token'])
+
+    def test_expired_token(self):
+        store = {'sync_token': 'old', 'time_max': '9999',
+                 'events': {u'gone': event(u'gone')}}
+        http = FakeHttp([
+            (410, {}),
+            (200, {'items': [event(u'a')], 'nextSyncToken': 'new'})])
+        events = google_calendar.sync(http, 'first.last@example.com', store)
+        self.assertEqual(['a'], list(events))
+        self.assertEqual('new', store['sync_token'])
+        self.assertIn('timeMin', http.urls[1])
+
+    def test_old_events_dropped(self):
+        store = dict()
+        http = FakeHttp([
+            (200, {'items': [event(u'a'), event(u'old', days=30)],
+                   'nextSyncToken': 'tok'})])
+        events = google_calendar.sync(http, 'first.last@example.com', store)
+        self.assertEqual([u'a'], list(events))
+        actual = google_calendar.process_items(events.values(),
+                                               'first.last@example.com')
+        self.assertEqual([u'a@google.com'], [x['key'] for x in actual])
+
+
+class TestPagedFetch(unittest.TestCase):
+
+    def setUp(self):
+        items = json.loads(open('./test_data/google_calendar.json').read())[
+            'items']
+        self.http = FakeHttp([
+            (200, {'items': items[:10], 'nextPageToken': 'page2'}),
+            (200, {'items': items[10:]})])
+        self.items = items
+        self.saved = google_calendar.do_google_oauth_stuff
+        google_calendar.do_google_oauth_stuff = lambda: self.http
+
+    def tearDown(self):
+        google_calendar.do_google_oauth_stuff = self.saved
+
+    def test_all_pages(self):
+        actual = google_calendar.go('first.last@example.com')
+        expected = google_calendar.process_items(
+            json.loads(json.dumps(self.items)), 'first.last@example.com')
+        self.assertEqual(expected, actual)
+        self.assertEqual(2, len(self.http.urls))
+        self.assertIn('fields=', self.http.urls[0])
+        self.assertIn('pageToken=page2', self.http.urls[1])
+
+
+class FakeCredentials(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.clients = list()
+
+    def authorize(self, http):
+        http = RoutingHttp(self.pages)
+        self.clients.append(http)
+        return http
+
+
+class RoutingHttp(FakeHttp):
+    '''
+    Answers with the page for whichever calendar is in the URL
+    '''
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.urls = list()
+
+    def request(self, url, method):
+        self.urls.append(url)
+        for calendar_name, page in self.pages.items():
+            if urllib.quote(calendar_name) in url:
+                return FakeResponse(200), json.dumps(page)
+
+
+class TestMultipleCalendars(unittest.TestCase):
+
+    def setUp(self):
+        self.calendars = ['first.last@example.com', 'room@example.com',
+                          'team@example.com']
+        pages = {x: {'items': [event(x.split('@')[0])]}
+                 for x in self.calendars}
+        self.credentials = FakeCredentials(pages)
+        self.saved = google_calendar.get_credentials
+        google_calendar.get_credentials = lambda: self.credentials
+
+    def tearDown(self):
+        google_calendar.get_credentials = self.saved
+
+    def test_concurrent(self):
+        actual = google_calendar.go_all(self.calendars, workers=3)
+        self.assertEqual(self.calendars, [x['calendar_name'] for x in actual])
+        self.assertEqual(['first.last', 'room', 'team'],
+                         [x['title'] for x in actual])
+
+    def test_connection_reused(self):
+        state = dict()
+        google_calendar.go_all(self.calendars, state, workers=1)
+        self.assertEqual(1, len(self.credentials.clients))
+        self.assertEqual(3, len(self.credentials.clients[0].urls))
+        self.assertEqual(sorted(self.calendars), sorted(state))
@@ -1,4 +1,5 @@
 import collections
+import os
 import tempfile
 import unittest
 from os.path import basename, split
@@ -8,6 +9,7 @@ from configobj import ConfigObj
 from sh import git as gitsh
 
 from publishers import git
+from publishers import git_objects
 
 
 def overwrite(file_object, text):
@@ -77,6 +79,62 @@ class TestGit(unittest.TestCase):
         self.assertEqual(expected, actual[0]['repo_name'])
         self.assertEqual(['message'], actual[0]['notes'])
 
+    def test_go_non_ascii_description(self):
+        repo_path = test_git_repo()
+        repo_name = basename(repo_path.name)
+        try:
+            overwrite(open('{}/.git/description'.format(repo_path.name), 'w'),
+                      u'Caf\xe9 project'.encode('utf-8'))
+            config = dict(self.config)
+            config['repo_dirs'] = [repo_path.name]
+            actual = git.go(config)
+        finally:
+            repo_path.dissolve()
+        expected = u'{} (Caf\xe9 project)/master'.format(repo_name)
+        self.assertEqual(expected, actual[0]['key'])
+
+    def test_go_parallel(self):
+        other_repo = test_git_repo()
+        try:
+            config = dict(self.config)
+            config['repo_dirs'] = [self.repo_path.name, other_repo.name]
+            expected = git.go(config)
+            config['workers'] = '4'
+            actual = git.go(config)
+        finally:
+            other_repo.dissolve()
+        self.assertEqual(2, len(actual))
+        self.assertEqual(expected, actual)
+
+    def test_go_incremental(self):
+        repo_path = test_git_repo()
+        try:
+            config = dict(self.config)
+            config['repo_dirs'] = [repo_path.name]
+            state = dict()
+            self.assertEqual(1, len(git.go(config, state)))
+            # nothing has moved, so nothing should be read:
+            self.assertEqual([], git.go(config, state))
+
+            repo_file = tempfile.NamedTemporaryFile(dir=repo_path.name,
+                                                    delete=False)
+            overwrite(repo_file, '456\n')
+            gitsh.add(repo_file.name, _cwd=repo_path.name)
+            gitsh.commit(m='second', author='First Last <first.last@a.com>',
+                         _cwd=repo_path.name)
+            actual = git.go(config, state)
+        finally:
+            repo_path.dissolve()
+        self.assertEqual(1, len(actual))
+        self.assertEqual(['second'], actual[0]['notes'])
+
+    def test_ref_tips(self):
+        actual = git.ref_tips(self.git_repo_path)
+        self.assertEqual(['refs/heads/master'], actual.keys())
+        expected = str(gitsh('--git-dir', self.git_repo_path, 'rev-parse',
+                             'master')).strip()
+        self.assertEqual(expected, actual['refs/heads/master'])
+
     def test_list_of_local_repos(self):
         dir = split(split(self.git_repo_path)[0])[0]
         actual = git.list_of_local_repos([dir])
@@ -95,6 +153,35 @@ class TestGit(unittest.TestCase):
         self.assertEqual('message', actual[0]['commit_message'])
         self.assertEqual('master', actual[0]['branch'])
 
+    def test_git_log_branch(self):
+        repo_path = test_git_repo()
+        try:
+            gitsh.checkout('-b', 'feature', _cwd=repo_path.name)
+            repo_file = tempfile.NamedTemporaryFile(dir=repo_path.name,
+                                                    delete=False)
+            overwrite(repo_file, '456\n')
+            gitsh.add(repo_file.name, _cwd=repo_path.name)
+            gitsh.commit(m='feature work',
+                         author='First Last <first.last@a.com>',
+                         _cwd=repo_path.name)
+            actual = git.log(repo='{}/.git'.format(repo_path.name), days=0,
+                             fields=self.fields, author='first')
+        finally:
+            repo_path.dissolve()
+        actual = dict((x['commit_message'], x['branch']) for x in actual)
+        self.assertEqual('feature', actual['feature work'])
+
+    def test_split_records(self):
+        lines = ['a\x1fb\n', 'c\x1e\n', '\x1ed\x1fe\x1e', '\n']
+        actual = list(git.split_records(iter(lines)))
+        self.assertEqual(['a\x1fb\nc', '\n', 'd\x1fe'], actual)
+
+    def test_iter_log(self):
+        entries = git.iter_log(repo=self.git_repo_path, days=0,
+                               fields=self.fields, author='first')
+        self.assertEqual('message', next(entries)['commit_message'])
+        self.assertRaises(StopIteration, next, entries)
+
     def test_add_fields(self):
         entries = [{'author': 'foo.bar@example.com',
                     'branch': ' (HEAD, master)',
@@ -113,3 +200,261 @@ class TestGit(unittest.TestCase):
                      'date': '2013-05-15 18:33:02 -0500'}]
         actual = git.add_fields(entries, self.git_repo_path, self.config)
         self.assertEqual(expected, actual)
+
+
+class TestFindRepos(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempdir.TempDir()
+        for path in ['a/.git/objects', 'a/nested/.git', 'b/c/d/.git',
+                     'node_modules/e/.git']:
+            os.makedirs(os.path.join(self.top.name, path))
+
+    def tearDown(self):
+        self.top.dissolve()
+
+    def path(self, path):
+        return os.path.join(self.top.name, path)
+
+    def test_stops_at_repo(self):
+        actual = git.find_repos(self.top.name)
+        expected = [self.path('a/.git'), self.path('b/c/d/.git'),
+                    self.path('node_modules/e/.git')]
+        self.assertEqual(expected, actual)
+
+    def test_excludes(self):
+        actual = git.find_repos(self.top.name, excludes=['node_modules'])
+        expected = [self.path('a/.git'), self.path('b/c/d/.git')]
+        self.assertEqual(expected, actual)
+
+    def test_max_depth(self):
+        actual = git.find_repos(self.top.name, max_depth=2)
+        expected = [self.path('a/.git'), self.path('node_modules/e/.git')]
+        self.assertEqual(expected, actual)
+
+    def test_cache(self):
+        cache = dict()
+        expected = git.list_of_local_repos([self.top.name], cache=cache)
+        self.assertIn(self.path('b/c'), cache)
+        # a stale listing is trusted as long as the mtime matches:
+        mtime, subdirs = cache[self.path('b/c')]
+        cache[self.path('b/c')] = (mtime, [])
+        actual = git.list_of_local_repos([self.top.name], cache=cache)
+        self.assertEqual(expected[:1] + expected[2:], actual)
+        # and is read again once the directory changes:
+        os.mkdir(self.path('b/c/f'))
+        os.utime(self.path('b/c'), (0, 0))
+        actual = git.list_of_local_repos([self.top.name], cache=cache)
+        self.assertEqual(expected, actual)
+        self.assertEqual(['d', 'f'], cache[self.path('b/c')][1])
+
+
+class TestDedupe(unittest.TestCase):
+
+    def setUp(self):
+        self.top = tempdir.TempDir()
+        self.origin = test_git_repo()
+        self.config = {'repo_dirs': [self.top.name],
+                       'duration': 600,
+                       'author': 'first.last',
+                       }
+        for name, args in (('plain', []), ('shared', ['--shared'])):
+            gitsh.clone(self.origin.name, name, *args, _cwd=self.top.name)
+        # move the shared clone on so that it isn't an exact copy:
+        shared = os.path.join(self.top.name, 'shared')
+        gitsh.commit('--allow-empty', m='more',
+                     author='First Last <first.last@a.com>', _cwd=shared)
+
+    def tearDown(self):
+        self.top.dissolve()
+        self.origin.dissolve()
+
+    def test_group_repos(self):
+        repos = ['{}/.git'.format(self.origin.name)]
+        repos.extend(sorted(git.list_of_local_repos([self.top.name])))
+        actual = git.group_repos(repos)
+        # the plain clone has the same tips as the origin and the shared
+        # clone borrows its objects:
+        self.assertEqual([repos], actual)
+
+    def test_go(self):
+        self.config['repo_dirs'].append(self.origin.name)
+        actual = git.go(self.config)
+        self.assertEqual(['message', 'more'],
+                         sorted(x['commit_message'] for x in actual))
+        self.config['dedupe'] = 'false'
+        actual = git.go(self.config)
+        self.assertEqual(4, len(actual))
+
+    def test_go_runs(self):
+        # another exact copy, read after (and so skipped in favour of) the
+        # plain clone:
+        gitsh.clone(self.origin.name, 'zcopy', _cwd=self.top.name)
+        state = dict()
+        actual = git.go(self.config, state)
+        self.assertEqual(['message', 'more'],
+                         sorted(x['commit_message'] for x in actual))
+        self.assertEqual([], git.go(self.config, state))
+
+        # the copy moves on; only the new commit is reported:
+        copy = os.path.join(self.top.name, 'zcopy')
+        gitsh.commit('--allow-empty', m='two',
+                     author='First Last <first.last@a.com>', _cwd=copy)
+        actual = git.go(self.config, state)
+        self.assertEqual(['two'], [x['commit_message'] for x in actual])
+
+
+    def test_go_clones_added(self):
+        state = dict()
+        git.go(self.config, state)
+        # an exact copy of a repo read last time and a clone borrowing its
+        # objects (and so grouped with the copy through it) with a new
+        # commit; only that commit is reported:
+        plain = os.path.join(self.top.name, 'plain')
+        gitsh.clone(plain, 'a', _cwd=self.top.name)
+        gitsh.clone(plain, 'b', '--shared', _cwd=self.top.name)
+        gitsh.commit('--allow-empty', m='new',
+                     author='First Last <first.last@a.com>',
+                     _cwd=os.path.join(self.top.name, 'b'))
+        repos = sorted(git.list_of_local_repos([self.top.name]))
+        self.assertEqual(repos[:3], git.group_repos(repos)[0])
+        actual = git.go(self.config, state)
+        self.assertEqual(['new'], [x['commit_message'] for x in actual])
+
+
+class TestSelectRefs(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = test_git_repo()
+        self.git_dir = '{}/.git'.format(self.repo_path.name)
+        # a branch that hasn't been touched in years:
+        gitsh.checkout('-b', 'stale', _cwd=self.repo_path.name)
+        env = dict(os.environ, GIT_COMMITTER_DATE='2001-01-01T00:00:00')
+        gitsh.commit('--allow-empty', m='old',
+                     author='First Last <first.last@a.com>',
+                     _cwd=self.repo_path.name, _env=env)
+        gitsh.branch('svn-trunk', _cwd=self.repo_path.name)
+        self.tips = git.ref_tips(self.git_dir)
+
+    def tearDown(self):
+        self.repo_path.dissolve()
+
+    def test_patterns(self):
+        actual = git.select_refs(self.git_dir, self.tips,
+                                 include=['refs/heads/*'],
+                                 exclude=['refs/heads/svn-*'])
+        self.assertEqual(['refs/heads/master', 'refs/heads/stale'],
+                         sorted(actual))
+
+    def test_recency(self):
+        actual = git.select_refs(self.git_dir, self.tips, days=7)
+        self.assertEqual(['refs/heads/master'], sorted(actual))
+
+    def test_log_refs(self):
+        fields = collections.OrderedDict()
+        fields['date'] = '%ai'
+        fields['commit_message'] = '%B'
+        config = {'author': 'first', 'duration': 600}
+        actual = git.process_repo(self.git_dir, fields, config)
+        self.assertEqual(['message', 'old'],
+                         [x['commit_message'] for x in actual])
+        config['ref_days'] = '7'
+        actual = git.process_repo(self.git_dir, fields, config)
+        self.assertEqual(['message'], [x['commit_message'] for x in actual])
+        config['include_refs'] = 'refs/heads/nothing'
+        self.assertEqual([], git.process_repo(self.git_dir, fields, config))
+
+
+class TestGitObjects(unittest.TestCase):
+
+    def setUp(self):
+        self.fields = collections.OrderedDict()
+        self.fields['author'] = '%ae'
+        self.fields['branch'] = '%d'
+        self.fields['date'] = '%ai'
+        self.fields['commit_message'] = '%B'
+        self.fields['commit_hash'] = '%H'
+
+        self.repo_path = test_git_repo()
+        self.git_dir = '{}/.git'.format(self.repo_path.name)
+        self.first = self.rev_parse('master')
+        repo_file = open('{}/file'.format(self.repo_path.name), 'w')
+        for number in range(20):
+            # keep adding to one file so that a repack makes deltas:
+            repo_file.write('line {}\n'.format(number) * 50)
+            repo_file.flush()
+            gitsh.add('file', _cwd=self.repo_path.name)
+            gitsh.commit(m='commit {}'.format(number),
+                         author='First Last <first.last@a.com>',
+                         _cwd=self.repo_path.name)
+            if number == 10:
+                gitsh.checkout('-b', 'feature', _cwd=self.repo_path.name)
+        repo_file.close()
+        gitsh.tag('-a', 'v1', '-m', 'tag', _cwd=self.repo_path.name)
+
+    def tearDown(self):
+        self.repo_path.dissolve()
+
+    def rev_parse(self, name):
+        return str(gitsh('--git-dir', self.git_dir, 'rev-parse',
+                         name)).strip()
+
+    def compare(self, **kwargs):
+        expected = git.log(repo=self.git_dir, fields=self.fields,
+                           author='first', days=0, **kwargs)
+        actual = git_objects.log(self.git_dir, git.ref_tips(self.git_dir),
+                                 self.fields, author='first', days=0,
+                                 **kwargs)
+        # the decorations are only approximately the same as git's:
+        for entry in expected + actual:
+            del entry['branch']
+        self.assertEqual(expected, actual)
+        return actual
+
+    def test_loose_objects(self):
+        self.assertEqual(21, len(self.compare()))
+
+    def test_packed_objects(self):
+        gitsh('--git-dir', self.git_dir, 'gc', '--aggressive', '-q')
+        loose = [x for x in os.listdir('{}/objects'.format(self.git_dir))
+                 if len(x) == 2]
+        self.assertEqual([], loose)
+        self.assertEqual(21, len(self.compare()))
+
+    def test_deltas(self):
+        gitsh('--git-dir', self.git_dir, 'gc', '--aggressive', '-q')
+        index = [x for x in os.listdir('{}/objects/pack'.format(self.git_dir))
+                 if x.endswith('.idx')][0]
+        verified = gitsh('--git-dir', self.git_dir, 'verify-pack', '-v',
+                         '{}/objects/pack/{}'.format(self.git_dir, index))
+        # deltified objects have the depth and base hash on the end:
+        deltas = [x.split() for x in str(verified).splitlines()
+                  if len(x.split()) == 7]
+        self.assertTrue(deltas)
+        store = git_objects.Repository(self.git_dir)
+        try:
+            for line in deltas:
+                expected = gitsh('--git-dir', self.git_dir, 'cat-file',
+                                 line[1], line[0]).stdout
+                self.assertEqual(expected, store.read_raw(line[0])[1])
+        finally:
+            store.close()
+
+    def test_exclude(self):
+        actual = self.compare(exclude=[self.first])
+        self.assertEqual(20, len(actual))
+
+    def test_branch(self):
+        actual = git_objects.log(self.git_dir, git.ref_tips(self.git_dir),
+                                 self.fields, author='first', days=0)
+        expected = git.log(repo=self.git_dir, fields=self.fields,
+                           author='first', days=0)
+        self.assertEqual([x['branch'] for x in expected],
+                         [x['branch'] for x in actual])
+
+    def test_backend_fallback(self):
+        config = {'author': 'first', 'backend': 'native'}
+        fields = dict(self.fields)
+        fields['subject'] = '%f'
+        actual = git.read_log(self.git_dir, fields, config)
+        self.assertEqual('commit-19', actual[0]['subject'])
@@ -1,8 +1,13 @@
 # TODO: write test for one without a context
 from lxml import etree
-#import shelve
+import shelve
+import datetime
+import os
+import shutil
+import tempfile
 import unittest
 import StringIO
+import zipfile
 from configobj import ConfigObj
 
 #import sys
@@ -11,6 +16,8 @@ from configobj import ConfigObj
 from publishers.omnifocus import OmniFocus
 from publishers.omnifocus import get_project
 from publishers.omnifocus import get_context
+from publishers.omnifocus import Hierarchy
+from publishers.omnifocus import TaskStore
 #from publishers.omnifocus import follow_idref
 from publishers.omnifocus import ns
 
@@ -197,6 +204,27 @@ class TestProcessXml(unittest.TestCase):
 
         self.assertEqual(expected, actual)
 
+    def test_estimate_before_completion(self):
+        # only an estimate after the completion date counts:
+        xml = open('./test_data/completion-without-context-or-project.xml'
+                   ).read()
+        root = etree.fromstring(xml)
+        task = root[0]
+        estimate = task.find('of:estimated-minutes', namespaces=ns)
+        self.assertEqual('55', self.of.read_task(task)[1]['estimatedMinutes'])
+        task.insert(0, estimate)
+        saved, out = self.of.read_task(task)
+        self.assertEqual('10', out['estimatedMinutes'])
+        self.assertEqual(('bogus', [], []), saved)
+
+    def test_ids_per_document(self):
+        self.of.process_xml(self.xml)
+        # the same id means something else in the next document:
+        xml = self.xml.replace('      MM\n', '      Errands\n')
+        actual = self.of.process_xml(xml)
+        self.assertEqual([['Errands'], ['Errands']],
+                         [x['context'] for x in actual])
+
 
 class TestGetProject(unittest.TestCase):
 
@@ -215,3 +243,267 @@ class TestGetProject(unittest.TestCase):
         expected = ['MM', 'MM-Foobar', None, 'GA']
         actual = get_project(self.node)
         self.assertEqual(expected, actual)
+
+
+# a completed task without a name:
+NAMELESS = """<?xml version="1.0" ?>
+<omnifocus xmlns="http://www.omnigroup.com/namespace/OmniFocus/v1">
+  <task id="gvV6CivYFVK" op="update">
+    <inbox/>
+    <completed>2012-09-15T19:21:16.336Z</completed>
+  </task>
+</omnifocus>
+"""
+
+
+class TestProcessStream(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConfigObj('test_data/config')['omnifocus']
+        self.config['days_ago'] = '100000'
+
+    def test_same_as_tree(self):
+        for name in ('contents-test.xml', 'contents-non-update.xml',
+                     'nested-contexts.xml', 'nested-projects.xml',
+                     'completion-without-context-or-project.xml',
+                     NAMELESS):
+            if name.startswith('<'):
+                xml = name
+            else:
+                xml = open('./test_data/{}'.format(name)).read()
+            tree = OmniFocus(self.config, dict())
+            stream = OmniFocus(self.config, dict())
+            self.assertEqual(tree.read_xml(xml),
+                             stream.read_stream(StringIO.StringIO(xml)))
+            expected = tree.process_xml(xml)
+            self.assertEqual(expected,
+                             stream.process_stream(StringIO.StringIO(xml)))
+            self.assertEqual(tree.id_map, stream.id_map)
+
+    def test_forward_reference(self):
+        # contexts and folders are defined after the tasks that use them:
+        xml = open('./test_data/contents-non-update.xml').read()
+        root = etree.fromstring(xml)
+        for element in list(root):
+            if not element.tag.endswith('task'):
+                root.append(element)
+        actual = OmniFocus(self.config, dict()).process_stream(
+            StringIO.StringIO(etree.tostring(root)))
+        self.assertEqual(['Internet', 'Research'], actual[0]['context'])
+        self.assertEqual(['IT', 'Backup gmail'], actual[0]['project'])
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def test_same_as_tree_walk(self):
+        for name in ('nested-contexts.xml', 'nested-projects.xml',
+                     'contents-test.xml', 'contents-non-update.xml'):
+            root = etree.parse('./test_data/{}'.format(name)).getroot()
+            hierarchy = Hierarchy(root)
+            for task in root.iterfind('of:task', namespaces=ns):
+                node = task.find('of:name', namespaces=ns)
+                key = hierarchy.key(task)
+                self.assertEqual(get_context(node), hierarchy.context(key))
+                self.assertEqual(get_project(node), hierarchy.project(key))
+
+    def test_memoized(self):
+        root = etree.parse('./test_data/nested-contexts.xml').getroot()
+        hierarchy = Hierarchy(root)
+        self.assertEqual(['bogus3', 'Daily', 'Personal'],
+                         hierarchy.context('jqCkTm_n_x1'))
+        self.assertEqual(('bogus3', 'Daily'), hierarchy.contexts['bAmer7KCi7y'])
+        # callers get their own copy:
+        hierarchy.context('jqCkTm_n_x1').append('bogus')
+        self.assertEqual(['bogus3', 'Daily', 'Personal'],
+                         hierarchy.context('jqCkTm_n_x1'))
+
+
+DELETED = """<?xml version="1.0" ?>
+<omnifocus xmlns="http://www.omnigroup.com/namespace/OmniFocus/v1">
+  <task id="fsNDuBvq_J0" op="delete">
+    <completed>2013-06-12T18:37:03.517Z</completed>
+  </task>
+</omnifocus>
+"""
+
+
+class TestGo(unittest.TestCase):
+
+    def setUp(self):
+        self.config = ConfigObj('test_data/config')['omnifocus']
+        self.config['days_ago'] = '100000'
+        self.directory = tempfile.mkdtemp()
+        # transactions, in the order they're named in:
+        transactions = [
+            ('00000000000000=a+b.zip', ['contents-test.xml']),
+            ('20130612183703=b+c.zip', ['contents-non-update.xml',
+                                        'nested-contexts.xml']),
+            ('20130613000000=c+d.zip', [DELETED]),
+        ]
+        # written out of order so listdir doesn't happen to help:
+        for name, members in reversed(transactions):
+            zip_file = zipfile.ZipFile(os.path.join(self.directory, name),
+                                       'w')
+            for number, member in enumerate(members):
+                if member.startswith('<'):
+                    zip_file.writestr('contents{}.xml'.format(number), member)
+                else:
+                    zip_file.write('./test_data/{}'.format(member),
+                                   'contents{}.xml'.format(number))
+            zip_file.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_sequential(self):
+        id_map = dict()
+        actual = OmniFocus(self.config, id_map).go(self.directory)
+        self.assertEqual(
+            ['do something dumb', 'do something else',
+             'research how to back up Gmail', 'bogus1234',
+             'research how to back up Gmail'],
+            [x['task'] for x in actual])
+        # the delete was resolved from the transaction before it:
+        self.assertEqual('deleted', actual[-1]['disposition'])
+        self.assertIn('fsNDuBvq_J0', id_map)
+
+    def test_parallel(self):
+        expected_map = dict()
+        expected = OmniFocus(self.config, expected_map).go(self.directory)
+        self.config['workers'] = '3'
+        id_map = dict()
+        actual = OmniFocus(self.config, id_map).go(self.directory)
+        self.assertEqual(expected, actual)
+        self.assertEqual(expected_map, id_map)
+
+    def test_manifest(self):
+        expected = OmniFocus(self.config, dict()).go(self.directory)
+        # a shelve as in __main__, which only sees entries that are stored:
+        state = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state)
+        manifest = shelve.open(os.path.join(state, 'manifest'), flag='c')
+        self.addCleanup(manifest.close)
+        actual = OmniFocus(self.config, dict(), manifest).go(self.directory)
+        self.assertEqual(expected, actual)
+        self.assertEqual(3, len(manifest))
+
+        # nothing is read the second time round:
+        reads = list()
+        omnifocus = OmniFocus(self.config, dict(), manifest)
+        omnifocus.read_zip = lambda path, cached=(): reads.append(path)
+        path = os.path.join(self.directory, '20130613000000=c+d.zip')
+        os.utime(path, (0, 0))
+        self.assertEqual(expected, omnifocus.go(self.directory))
+        self.assertEqual([], reads)
+        self.assertEqual(0, manifest['20130613000000=c+d.zip']['mtime'])
+
+        # files that have gone are forgotten:
+        os.remove(path)
+        OmniFocus(self.config, dict(), manifest).go(self.directory)
+        self.assertNotIn('20130613000000=c+d.zip', manifest)
+
+    def test_manifest_window(self):
+        # what's cached is filtered by the window when it's replayed:
+        manifest = dict()
+        OmniFocus(self.config, dict(), manifest).go(self.directory)
+        self.config['days_ago'] = '1'
+        actual = OmniFocus(self.config, dict(), manifest).go(self.directory)
+        self.assertEqual([], actual)
+        self.config['days_ago'] = '100000'
+        actual = OmniFocus(self.config, dict(), manifest).go(self.directory)
+        self.assertEqual(5, len(actual))
+
+    def test_old_files_skipped(self):
+        # a window that starts after the second transaction was made:
+        days = (datetime.datetime.now() - datetime.datetime(2013, 6, 12, 23))
+        self.config['days_ago'] = str(days.days)
+        reads = list()
+        omnifocus = OmniFocus(self.config, dict())
+        omnifocus.read_zip = lambda path, cached=(): reads.append(
+            os.path.basename(path)) or list()
+        omnifocus.go(self.directory)
+        self.assertEqual(['00000000000000=a+b.zip', '20130613000000=c+d.zip'],
+                         reads)
+
+    def test_too_old(self):
+        self.config['days_ago'] = '10'
+        omnifocus = OmniFocus(self.config, dict())
+        # the window is reckoned from local time, as it always has been:
+        now = datetime.datetime.now()
+        for days, expected in ((11, True), (9, False), (10.0001, True),
+                               (9.9999, False)):
+            completed = now - datetime.timedelta(days=days)
+            for text in (completed.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                         completed.strftime('%Y-%m-%d %H:%M:%S+00:00')):
+                self.assertEqual(expected, omnifocus.too_old(text))
+
+    def test_member_cache(self):
+        expected = OmniFocus(self.config, dict()).go(self.directory)
+        # the same member again in a later transaction:
+        zip_file = zipfile.ZipFile(
+            os.path.join(self.directory, '20130614000000=d+e.zip'), 'w')
+        zip_file.write('./test_data/nested-contexts.xml', 'again.xml')
+        zip_file.close()
+
+        reads = list()
+        cache = dict()
+        omnifocus = OmniFocus(self.config, dict(), cache=cache)
+        read_xml_file = omnifocus.read_xml_file
+        omnifocus.read_xml_file = lambda zip_file, info: reads.append(
+            info.filename) or read_xml_file(zip_file, info)
+        actual = omnifocus.go(self.directory)
+        self.assertEqual(expected + [expected[3]], actual)
+        self.assertEqual(4, len(reads))
+        self.assertEqual(4, len(cache))
+
+        # and nothing is read once everything's in the cache:
+        del reads[:]
+        self.assertEqual(actual, omnifocus.go(self.directory))
+        self.assertEqual([], reads)
+
+    def test_tree(self):
+        expected = OmniFocus(self.config, dict()).go(self.directory)
+        self.config['stream'] = 'False'
+        self.assertEqual(expected,
+                         OmniFocus(self.config, dict()).go(self.directory))
+
+
+class TestTaskStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'tasks.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_store(self):
+        store = TaskStore(self.filename, batch_size=2)
+        store['a'] = ('task a', ['MM'], ['Bogus', 'bogus2'])
+        # nothing's written until there's a batch of them:
+        self.assertEqual(1, len(store.pending))
+        self.assertEqual(('task a', ['MM'], ['Bogus', 'bogus2']), store['a'])
+        store['b'] = ('task b', [], [])
+        self.assertEqual(0, len(store.pending))
+        store['c'] = ('task c', [], [])
+        self.assertNotIn('d', store)
+        self.assertRaises(KeyError, lambda: store['d'])
+        store.close()
+
+        store = TaskStore(self.filename)
+        self.assertEqual(3, len(store))
+        self.assertEqual(('task c', [], []), store['c'])
+        store.close()
+
+    def test_as_id_map(self):
+        xml = open('./test_data/contents-test.xml').read()
+        config = ConfigObj('test_data/config')['omnifocus']
+        store = TaskStore(self.filename)
+        expected = dict()
+        OmniFocus(config, expected).process_xml(xml)
+        OmniFocus(config, store).process_xml(xml)
+        self.assertEqual(len(expected), len(store))
+        for identity, (name, context, project) in expected.items():
+            self.assertEqual((name, context, project), store[identity])
+        store.close()
+